@@ -200,6 +200,7 @@ class hadoop ($hadoop_security_authentication = "simple",
       $hadoop_namenode_https_bind_host = undef,
       $hdfs_data_dirs = suffix($hadoop::hadoop_storage_dirs, "/hdfs"),
       $hdfs_shortcut_reader = undef,
+      $hdfs_domain_socket_path = "/var/lib/hadoop-hdfs/dn_socket",
       $hdfs_support_append = undef,
       $hdfs_replace_datanode_on_failure = undef,
       $hdfs_webhdfs_enabled = "true",
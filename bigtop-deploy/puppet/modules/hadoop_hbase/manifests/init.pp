@@ -42,7 +42,17 @@ class hadoop_hbase {
     }
   }
 
-  class common_config ($rootdir, $zookeeper_quorum, $kerberos_realm = "", $heap_size="1024") {
+  class common_config ($rootdir, $zookeeper_quorum, $kerberos_realm = "", $heap_size="1024",
+      $memstore_size = undef,
+      $block_cache_size = undef,
+      $bucketcache_size = undef,
+      $offheap_size = undef,
+      $major_compaction_period = undef,
+      $compaction_throughput = undef,
+      $offpeak_start_hour = undef,
+      $offpeak_end_hour = undef,
+      $hdfs_shortcut_reader_user = undef,
+      $hdfs_domain_socket_path = "/var/lib/hadoop-hdfs/dn_socket") {
     include hadoop_hbase::client_package
     if ($kerberos_realm and $kerberos_realm != "") {
       require kerberos::client
@@ -32,6 +32,11 @@ export HBASE_CLASSPATH=/etc/hadoop/conf
 # The maximum amount of heap to use. Default is left to JVM default.
 # export HBASE_HEAPSIZE=1G
 export HBASE_HEAPSIZE=<%= @heap_size %>
+<% if @offheap_size -%>
+# Only the RegionServer holds the off-heap BucketCache; HBASE_OFFHEAPSIZE
+# would raise the direct memory limit of every HBase daemon.
+export HBASE_REGIONSERVER_OPTS="$HBASE_REGIONSERVER_OPTS -XX:MaxDirectMemorySize=<%= @offheap_size %>"
+<% end -%>
 
 # Uncomment below if you intend to use off heap cache. For example, to allocate 8G of 
 # offheap, set the value to "8G".
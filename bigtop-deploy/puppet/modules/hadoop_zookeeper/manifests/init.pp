@@ -66,6 +66,9 @@ class hadoop_zookeeper (
                 $client_bind_addr = "",
                 $autopurge_purge_interval = "24",
                 $autopurge_snap_retain_count = "3",
+                $datalogdir = "",
+                $preallocsize = "",
+                $peer_type = "",
   ) inherits hadoop_zookeeper {
     include hadoop_zookeeper::common
 
@@ -27,6 +27,14 @@ class kafka {
       $bind_addr = undef,
       $port = "9092",
       $zookeeper_connection_string = "localhost:2181",
+      $num_network_threads = "2",
+      $num_io_threads = "8",
+      $num_replica_fetchers = "1",
+      $socket_send_buffer_bytes = "1048576",
+      $socket_receive_buffer_bytes = "1048576",
+      $log_segment_bytes = "536870912",
+      $heap_opts = undef,
+      $jmx_port = undef,
     ) {
 
     package { 'kafka':
@@ -44,12 +52,18 @@ class kafka {
       group   => 'kafka',
     }
 
+    file { '/etc/default/kafka-server':
+      content => template('kafka/kafka-server.default'),
+      require => Package['kafka-server'],
+    }
+
     service { 'kafka-server':
       ensure     => running,
       subscribe  => [
           Package['kafka'],
           Package['kafka-server'],
           File['/etc/kafka/conf/server.properties'],
+          File['/etc/default/kafka-server'],
        ],
       hasrestart => true,
       hasstatus  => true,
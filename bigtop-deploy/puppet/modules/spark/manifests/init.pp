@@ -156,6 +156,7 @@ class spark {
       $extra_lib_dirs = "/usr/lib/hadoop/lib/native",
       $driver_mem = "1g",
       $executor_mem = "1g",
+      $hdfs_domain_socket_path = undef,
   ) {
 
 ### This is an ungodly hack to deal with the consequence of adding
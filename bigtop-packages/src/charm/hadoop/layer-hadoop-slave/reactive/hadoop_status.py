@@ -31,6 +31,7 @@ from charmhelpers.core.hookenv import status_set
     'namenode.ready',
     'resourcemanager.joined',
     'resourcemanager.ready',
+    'hadoop-slave.short-circuit',
 )
 def update_status():
     hdfs_rel = is_state('namenode.joined')
@@ -51,4 +52,7 @@ def update_status():
             ready.append('datanode')
         if yarn_ready:
             ready.append('nodemanager')
-        status_set('active', 'ready ({})'.format(' & '.join(ready)))
+        message = 'ready ({})'.format(' & '.join(ready))
+        if hdfs_ready and is_state('hadoop-slave.short-circuit'):
+            message += ', short-circuit reads'
+        status_set('active', message)
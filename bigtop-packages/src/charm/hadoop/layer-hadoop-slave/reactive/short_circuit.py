@@ -0,0 +1,75 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import stat
+import time
+
+from charms.reactive import when, when_not, set_state, remove_state
+from charmhelpers.core import hookenv, host
+from jujubigdata import utils
+
+
+HDFS_SITE = '/etc/hadoop/conf/hdfs-site.xml'
+# Bigtop's default; the hbase and spark charms look for the same path.
+DN_SOCKET = '/var/lib/hadoop-hdfs/dn_socket'
+
+
+def socket_ready():
+    try:
+        return stat.S_ISSOCK(os.stat(DN_SOCKET).st_mode)
+    except OSError:
+        return False
+
+
+@when('apache-bigtop-datanode.started')
+def configure_short_circuit():
+    '''
+    Let clients on this machine (e.g. colocated HBase RegionServers and
+    Spark executors) read blocks straight from local disk, by having the
+    DataNode serve a domain socket.
+
+    The datanode layer re-renders hdfs-site.xml whenever it reconfigures,
+    so check the settings on every hook and restore them if needed.
+    '''
+    # The socket directory must only be writable by hdfs (or root).
+    host.mkdir(os.path.dirname(DN_SOCKET), owner='hdfs', group='hdfs',
+               perms=0o755)
+    with utils.xmlpropmap_edit_in_place(HDFS_SITE) as props:
+        changed = (props.get('dfs.client.read.shortcircuit') != 'true' or
+                   props.get('dfs.domain.socket.path') != DN_SOCKET)
+        props['dfs.client.read.shortcircuit'] = 'true'
+        props['dfs.domain.socket.path'] = DN_SOCKET
+    if changed:
+        hookenv.log('Enabling short-circuit reads on {}'.format(DN_SOCKET))
+        host.service_restart('hadoop-hdfs-datanode')
+        # Give the DataNode a moment to open its socket.
+        for _ in range(30):
+            if socket_ready():
+                break
+            time.sleep(1)
+
+    if socket_ready():
+        set_state('hadoop-slave.short-circuit')
+    else:
+        hookenv.log('DataNode is not serving {}'.format(DN_SOCKET),
+                    hookenv.WARNING)
+        remove_state('hadoop-slave.short-circuit')
+
+
+@when('hadoop-slave.short-circuit')
+@when_not('apache-bigtop-datanode.started')
+def short_circuit_stopped():
+    remove_state('hadoop-slave.short-circuit')
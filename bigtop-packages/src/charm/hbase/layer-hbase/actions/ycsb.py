@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+YCSB-style load client for the HBase Thrift gateway.
+
+Loads a table with records, then runs one of the YCSB core workloads
+(A-F) against it from several processes, and reports throughput and
+latency percentiles per operation:
+
+    A  update heavy       50% read, 50% update
+    B  read mostly        95% read, 5% update
+    C  read only          100% read
+    D  read latest        95% read, 5% insert; reads favour recent records
+    E  short ranges       95% scan, 5% insert
+    F  read-modify-write  50% read, 50% read-modify-write
+
+Used by the ycsb action, but can also be pointed at any Thrift gateway, or
+at a local stand-in server that keeps the table in memory (for testing the
+client without an HBase cluster):
+
+    ./ycsb.py --host 127.0.0.1 --port 9090 --workload A
+    ./ycsb.py --standin --workload E --records 1000 --operations 1000
+"""
+
+import argparse
+import bisect
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import time
+
+import happybase
+
+WORKLOADS = {
+    'A': {'read': 0.5, 'update': 0.5},
+    'B': {'read': 0.95, 'update': 0.05},
+    'C': {'read': 1.0},
+    'D': {'read': 0.95, 'insert': 0.05},
+    'E': {'scan': 0.95, 'insert': 0.05},
+    'F': {'read': 0.5, 'rmw': 0.5},
+}
+OPERATIONS = ('read', 'update', 'insert', 'scan', 'rmw')
+FAMILY = 'cf'
+MAX_SCAN_LENGTH = 100
+
+FNV_OFFSET_BASIS_64 = 0xCBF29CE484222325
+FNV_PRIME_64 = 1099511628211
+
+
+def fnv_hash64(value):
+    """FNV-1a hash, as YCSB uses to scatter keys across the key space."""
+    result = FNV_OFFSET_BASIS_64
+    for _ in range(8):
+        result ^= value & 0xff
+        result = (result * FNV_PRIME_64) & 0xffffffffffffffff
+        value >>= 8
+    return result
+
+
+def build_key(keynum):
+    return 'user{}'.format(fnv_hash64(keynum)).encode('utf8')
+
+
+class ZipfianGenerator(object):
+    """
+    Zipfian distributed integers in [0, items), popular items first
+    (Gray et al., "Quickly Generating Billion-Record Synthetic Databases").
+    """
+    def __init__(self, items, theta=0.99, rng=random):
+        if items < 1:
+            raise ValueError('Zipfian needs at least one item')
+        self.items = items
+        self.theta = theta
+        self.rng = rng
+        self.zetan = self._zeta(items)
+        zeta2 = self._zeta(2)
+        self.alpha = 1.0 / (1.0 - theta)
+        self.eta = ((1 - math.pow(2.0 / items, 1 - theta)) /
+                    (1 - zeta2 / self.zetan))
+
+    def _zeta(self, n):
+        return sum(1 / math.pow(i + 1, self.theta) for i in range(n))
+
+    def next(self):
+        u = self.rng.random()
+        uz = u * self.zetan
+        if uz < 1.0:
+            return 0
+        if uz < 1.0 + math.pow(0.5, self.theta):
+            return 1
+        return int(self.items *
+                   math.pow(self.eta * u - self.eta + 1, self.alpha))
+
+
+class ScrambledZipfianGenerator(ZipfianGenerator):
+    """Zipfian popularity, with the popular items spread out."""
+    def next(self):
+        return fnv_hash64(super(ScrambledZipfianGenerator, self).next()) % \
+            self.items
+
+
+class UniformGenerator(object):
+    def __init__(self, items, rng=random):
+        self.items = items
+        self.rng = rng
+
+    def next(self):
+        return self.rng.randrange(self.items)
+
+
+def weighted_choice(choices, cum_weights, rng=random):
+    """
+    Pick from choices given their cumulative weights (random.choices
+    is not available on Python 3.5).
+    """
+    return choices[bisect.bisect(cum_weights, rng.random() * cum_weights[-1])]
+
+
+def cumulative(weights):
+    total, cum_weights = 0, []
+    for weight in weights:
+        total += weight
+        cum_weights.append(total)
+    return cum_weights
+
+
+def percentile(latencies, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not latencies:
+        return 0
+    rank = int(math.ceil(round(pct * len(latencies) / 100.0, 6))) - 1
+    return latencies[min(max(rank, 0), len(latencies) - 1)]
+
+
+def make_record(fields, field_length):
+    value = os.urandom(field_length // 2 + 1).hex()[:field_length]
+    return dict(('{}:field{}'.format(FAMILY, i).encode('utf8'),
+                 value.encode('utf8')) for i in range(fields))
+
+
+class Worker(object):
+    """
+    One client process: its own Thrift connection, key generator and
+    latency log. Inserts during the run phase use keys that no other
+    worker will pick, by striding through the numbers past the loaded
+    records.
+    """
+    def __init__(self, opts, index):
+        self.opts = opts
+        self.index = index
+        self.rng = random.Random(opts['seed'] + index)
+        self.connection = happybase.Connection(
+            opts['host'], opts['port'], timeout=opts['timeout'] * 1000)
+        self.table = self.connection.table(opts['table'])
+        self.latencies = dict((op, []) for op in OPERATIONS)
+        self.errors = 0
+        self.next_insert = opts['records'] + index
+
+    def chooser(self, items):
+        if self.opts['distribution'] == 'uniform':
+            return UniformGenerator(items, self.rng)
+        return ScrambledZipfianGenerator(items, rng=self.rng)
+
+    def load(self, start, stop):
+        with self.table.batch(batch_size=100) as batch:
+            for keynum in range(start, stop):
+                batch.put(build_key(keynum), make_record(
+                    self.opts['fields'], self.opts['field_length']))
+
+    def run(self, count):
+        weights = WORKLOADS[self.opts['workload']]
+        ops = sorted(weights)
+        cum_weights = cumulative(weights[op] for op in ops)
+        records = self.opts['records']
+        keys = self.chooser(records)
+        latest = ZipfianGenerator(records, rng=self.rng)
+        for _ in range(count):
+            op = weighted_choice(ops, cum_weights, self.rng)
+            if self.opts['workload'] == 'D' and op == 'read':
+                # Favour the most recently inserted records.
+                keynum = max(self.next_insert - self.opts['processes'] -
+                             latest.next(), 0)
+            else:
+                keynum = keys.next()
+            start = time.time()
+            try:
+                getattr(self, op)(keynum)
+            except Exception:
+                self.errors += 1
+                continue
+            self.latencies[op].append((time.time() - start) * 1e6)
+
+    def read(self, keynum):
+        self.table.row(build_key(keynum))
+
+    def update(self, keynum):
+        field = self.rng.randrange(self.opts['fields'])
+        self.table.put(build_key(keynum), {
+            '{}:field{}'.format(FAMILY, field).encode('utf8'):
+                os.urandom(self.opts['field_length'] // 2 + 1).hex()
+                [:self.opts['field_length']].encode('utf8')})
+
+    def insert(self, keynum):
+        self.table.put(build_key(self.next_insert), make_record(
+            self.opts['fields'], self.opts['field_length']))
+        self.next_insert += self.opts['processes']
+
+    def scan(self, keynum):
+        length = self.rng.randint(1, MAX_SCAN_LENGTH)
+        for _ in self.table.scan(row_start=build_key(keynum), limit=length):
+            pass
+
+    def rmw(self, keynum):
+        self.read(keynum)
+        self.update(keynum)
+
+
+def _load(args):
+    opts, index, start, stop = args
+    worker = Worker(opts, index)
+    try:
+        worker.load(start, stop)
+    finally:
+        worker.connection.close()
+
+
+def _run(args):
+    opts, index, count = args
+    worker = Worker(opts, index)
+    try:
+        worker.run(count)
+    finally:
+        worker.connection.close()
+    return worker.latencies, worker.errors
+
+
+def _split(total, parts):
+    """Split total into parts that differ by at most one."""
+    return [total // parts + (1 if i < total % parts else 0)
+            for i in range(parts)]
+
+
+def run(host='127.0.0.1', port=9090, workload='A', records=10000,
+        operations=10000, processes=4, distribution='zipfian', fields=10,
+        field_length=100, table='usertable', load=True, timeout=30,
+        seed=None):
+    """
+    Load (unless ``load`` is False) and run a workload, and return a dict
+    of results. Latencies are in microseconds.
+    """
+    if workload not in WORKLOADS:
+        raise ValueError('Unknown workload: {}'.format(workload))
+    for name, value in (('records', records), ('operations', operations),
+                        ('processes', processes), ('fields', fields),
+                        ('field_length', field_length)):
+        if value < 1:
+            raise ValueError('{} must be at least 1'.format(name))
+    opts = {
+        'host': host, 'port': port, 'workload': workload,
+        'records': records, 'processes': processes,
+        'distribution': distribution, 'fields': fields,
+        'field_length': field_length, 'table': table, 'timeout': timeout,
+        'seed': seed if seed is not None else int(time.time()),
+    }
+
+    connection = happybase.Connection(host, port, timeout=timeout * 1000)
+    try:
+        if table.encode('utf8') not in connection.tables():
+            connection.create_table(table, {FAMILY: dict()})
+    finally:
+        connection.close()
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        load_duration = 0
+        if load:
+            start = time.time()
+            bounds = [0]
+            for size in _split(records, processes):
+                bounds.append(bounds[-1] + size)
+            pool.map(_load, [(opts, i, bounds[i], bounds[i + 1])
+                             for i in range(processes)])
+            load_duration = time.time() - start
+
+        start = time.time()
+        outcomes = pool.map(_run, [(opts, i, count) for i, count in
+                                   enumerate(_split(operations, processes))])
+        duration = time.time() - start
+    finally:
+        pool.close()
+        pool.join()
+
+    results = {
+        'workload': workload,
+        'processes': processes,
+        'load_duration': round(load_duration, 3),
+        'duration': round(duration, 3),
+        'errors': sum(errors for _, errors in outcomes),
+        'operations': {},
+    }
+    total = 0
+    for op in OPERATIONS:
+        latencies = sorted(l for latency, _ in outcomes for l in latency[op])
+        if not latencies:
+            continue
+        total += len(latencies)
+        results['operations'][op] = {
+            'count': len(latencies),
+            'ops_per_sec': round(len(latencies) / duration, 2),
+            'avg': round(sum(latencies) / len(latencies), 1),
+            'p50': round(percentile(latencies, 50), 1),
+            'p95': round(percentile(latencies, 95), 1),
+            'p99': round(percentile(latencies, 99), 1),
+        }
+    results['ops_per_sec'] = round(total / duration, 2) if duration else 0
+    return results
+
+
+class StandInServer(object):
+    """
+    A stand-in for the HBase Thrift gateway that keeps tables in memory.
+    It implements just the calls this client makes, so that the client
+    can be exercised without an HBase cluster.
+    """
+    def __init__(self, host='127.0.0.1', port=0):
+        import socket
+        if not port:
+            sock = socket.socket()
+            sock.bind((host, 0))
+            port = sock.getsockname()[1]
+            sock.close()
+        self.host = host
+        self.port = port
+        self.process = None
+
+    @staticmethod
+    def _serve(host, port):
+        import bisect
+        import pkg_resources
+        import thriftpy2
+        from thriftpy2.rpc import make_server
+
+        hbase = thriftpy2.load(
+            pkg_resources.resource_filename('happybase', 'Hbase.thrift'),
+            module_name='Hbase_standin_thrift')
+
+        def b(value):
+            return value if isinstance(value, bytes) else value.encode('utf8')
+
+        class Handler(object):
+            def __init__(self):
+                self.tables = {}
+                self.scanners = {}
+                self.scanner_ids = itertools.count(1)
+
+            def getTableNames(self):
+                return sorted(self.tables)
+
+            def createTable(self, tableName, columnFamilies):
+                self.tables[b(tableName)] = {'rows': {}, 'keys': []}
+
+            def isTableEnabled(self, tableName):
+                return b(tableName) in self.tables
+
+            def mutateRows(self, tableName, rowBatches, attributes):
+                table = self.tables[b(tableName)]
+                for batch in rowBatches:
+                    row = b(batch.row)
+                    if row not in table['rows']:
+                        bisect.insort(table['keys'], row)
+                        table['rows'][row] = {}
+                    for mutation in batch.mutations:
+                        if mutation.isDelete:
+                            table['rows'][row].pop(b(mutation.column), None)
+                        else:
+                            table['rows'][row][b(mutation.column)] = \
+                                b(mutation.value)
+
+            def _result(self, table, row):
+                now = int(time.time() * 1000)
+                return hbase.TRowResult(row=row, columns=dict(
+                    (column, hbase.TCell(value=value, timestamp=now))
+                    for column, value in table['rows'][row].items()))
+
+            def getRowWithColumns(self, tableName, row, columns, attributes):
+                table = self.tables[b(tableName)]
+                if b(row) not in table['rows']:
+                    return []
+                return [self._result(table, b(row))]
+
+            def getRow(self, tableName, row, attributes):
+                return self.getRowWithColumns(tableName, row, None,
+                                              attributes)
+
+            def scannerOpenWithScan(self, tableName, scan, attributes):
+                table = self.tables[b(tableName)]
+                start = bisect.bisect_left(table['keys'],
+                                           b(scan.startRow or b''))
+                scanner = next(self.scanner_ids)
+                self.scanners[scanner] = (table, start)
+                return scanner
+
+            def scannerGetList(self, id, nbRows):
+                table, start = self.scanners[id]
+                keys = table['keys'][start:start + nbRows]
+                self.scanners[id] = (table, start + len(keys))
+                return [self._result(table, key) for key in keys]
+
+            def scannerClose(self, id):
+                self.scanners.pop(id, None)
+
+        make_server(hbase.Hbase, Handler(), host, port).serve()
+
+    def start(self):
+        self.process = multiprocessing.Process(
+            target=self._serve, args=(self.host, self.port))
+        self.process.daemon = True
+        self.process.start()
+        # Wait for the server to accept connections.
+        import socket
+        for _ in range(50):
+            try:
+                socket.create_connection((self.host, self.port), 1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError('Stand-in server did not start')
+
+    def stop(self):
+        if self.process:
+            self.process.terminate()
+            self.process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='YCSB-style load client for the HBase Thrift gateway')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9090)
+    parser.add_argument('--standin', action='store_true',
+                        help='run against an in-memory stand-in server')
+    parser.add_argument('--workload', default='A', choices=sorted(WORKLOADS))
+    parser.add_argument('--records', type=int, default=10000,
+                        help='number of records to load')
+    parser.add_argument('--operations', type=int, default=10000,
+                        help='number of operations to run')
+    parser.add_argument('--processes', type=int, default=4,
+                        help='number of client processes')
+    parser.add_argument('--distribution', default='zipfian',
+                        choices=['zipfian', 'uniform'],
+                        help='how keys are chosen')
+    parser.add_argument('--fields', type=int, default=10,
+                        help='number of fields per record')
+    parser.add_argument('--field-length', type=int, default=100,
+                        help='size (in bytes) of each field')
+    parser.add_argument('--table', default='usertable')
+    parser.add_argument('--no-load', dest='load', action='store_false',
+                        help='skip the load phase')
+    args = parser.parse_args()
+
+    server = None
+    if args.standin:
+        server = StandInServer()
+        server.start()
+        args.host, args.port = server.host, server.port
+    try:
+        results = run(args.host, args.port, args.workload, args.records,
+                      args.operations, args.processes, args.distribution,
+                      args.fields, args.field_length, args.table, args.load)
+    finally:
+        if server:
+            server.stop()
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
+import re
+import stat
+import subprocess
+import time
+from urllib.parse import quote
+from urllib.request import urlopen
+from xml.etree import ElementTree
+
 from charmhelpers.core import hookenv, host, unitdata
 from charms import layer
 from charms.layer.apache_bigtop_base import Bigtop
@@ -20,6 +30,156 @@ from jujubigdata import utils
 from path import Path
 
 
+# Fractions of the RegionServer heap given to the memstore and the on-heap
+# block cache, and whether to add an off-heap BucketCache, per workload.
+TUNING_PROFILES = {
+    'balanced': {'memstore': 0.4, 'block_cache': 0.4, 'bucket_cache': False},
+    'read-heavy': {'memstore': 0.25, 'block_cache': 0.55,
+                   'bucket_cache': True},
+    'write-heavy': {'memstore': 0.55, 'block_cache': 0.25,
+                    'bucket_cache': False},
+}
+
+COMPACT_SCRIPT = '/usr/local/bin/hbase-compact'
+COMPACT_CRON = '/etc/cron.d/hbase-compaction'
+
+HBASE_SITE = '/etc/hbase/conf/hbase-site.xml'
+# Where a colocated DataNode serves short-circuit reads (Bigtop's default).
+DN_SOCKET = '/var/lib/hadoop-hdfs/dn_socket'
+
+REGIONSERVERS_FILE = '/etc/hbase/conf/regionservers'
+# Peer changes that arrive within this many seconds of the last rewrite of
+# the regionservers file are held back, so that a burst of joins or departs
+# is applied in one go.
+REGIONSERVERS_DEBOUNCE = 60
+# How many hooks in a row may find the master declining to balance (regions
+# in transition, or the balancer switched off) before a new RegionServer
+# stops asking for its share of the regions.
+REBALANCE_ATTEMPTS = 10
+
+
+def compaction_window(window):
+    '''
+    Parse a compaction window such as "1-5" (01:00 to 05:00, local time)
+    into (start hour, end hour). Returns None for an empty window, and
+    raises ValueError for an invalid one.
+    '''
+    if not window:
+        return None
+    try:
+        start, end = (int(hour) for hour in window.split('-'))
+    except ValueError:
+        raise ValueError('compaction window "{}" is not '
+                         'start-end'.format(window))
+    if not (0 <= start < 24 and 0 <= end < 24) or start == end:
+        raise ValueError('compaction window "{}" is out of '
+                         'range'.format(window))
+    return start, end
+
+
+# HBase refuses to start unless at least this much of the heap is left
+# for everything other than the memstore and block cache.
+MIN_FREE_HEAP = 0.2
+# The master, RegionServer and Thrift gateway each run with the configured
+# heap.
+HBASE_DAEMONS = 3
+# Hadoop daemons that may share the machine, and the memory each needs
+# (Bigtop's default Hadoop heap, plus JVM overhead).
+HADOOP_DAEMONS = ('hadoop-hdfs-datanode', 'hadoop-yarn-nodemanager')
+HADOOP_DAEMON_MB = 1024
+# RAM always left to the OS page cache, which HDFS reads go through.
+PAGE_CACHE_FRACTION = 0.25
+# Direct memory the RegionServer needs besides the BucketCache (DFSClient
+# and RPC buffers).
+DIRECT_BUFFERS_MB = 1024
+
+
+def jmx(host_name, port, query, timeout=10):
+    '''
+    Return the beans matching query (e.g.
+    'Hadoop:service=HBase,name=Master,sub=Server') from the JMX JSON
+    servlet of an HBase daemon's web UI.
+    '''
+    url = 'http://{}:{}/jmx?qry={}'.format(host_name, port, quote(query))
+    with urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read().decode('utf8')).get('beans', [])
+
+
+def datanode_colocated():
+    '''Return True if an HDFS DataNode runs on this machine.'''
+    return host.service_running('hadoop-hdfs-datanode')
+
+
+def hadoop_daemons_colocated():
+    '''Return how many Hadoop worker daemons run on this machine.'''
+    return len([service for service in HADOOP_DAEMONS
+                if host.service_running(service)])
+
+
+def short_circuit_active():
+    '''
+    Return True if HBase is configured for short-circuit reads and the
+    DataNode is serving its domain socket.
+    '''
+    try:
+        site = ElementTree.parse(HBASE_SITE)
+        props = dict((prop.findtext('name'), prop.findtext('value'))
+                     for prop in site.iter('property'))
+        configured = props.get('dfs.client.read.shortcircuit') == 'true'
+        return configured and stat.S_ISSOCK(os.stat(DN_SOCKET).st_mode)
+    except (OSError, ElementTree.ParseError):
+        return False
+
+
+def memory_tuning(config, ram_mb, hadoop_daemons=0):
+    '''
+    Work out the memstore, block cache and BucketCache settings for a unit
+    with ``ram_mb`` of RAM, from the ``tuning`` profile and any explicit
+    fractions in ``config``. Raises ValueError if the fractions would
+    leave less than MIN_FREE_HEAP of the heap free.
+
+    The off-heap BucketCache gets the RAM that is left once the heaps of
+    every HBase daemon and of ``hadoop_daemons`` colocated Hadoop daemons
+    are accounted for, keeping PAGE_CACHE_FRACTION of the RAM for the OS
+    page cache.
+    '''
+    profile = config.get('tuning') or 'balanced'
+    if profile not in TUNING_PROFILES:
+        raise ValueError('unknown tuning profile "{}"'.format(profile))
+    tuning = dict(TUNING_PROFILES[profile])
+    if config.get('memstore_fraction'):
+        tuning['memstore'] = config['memstore_fraction']
+    if config.get('block_cache_fraction'):
+        tuning['block_cache'] = config['block_cache_fraction']
+
+    for key in ('memstore', 'block_cache'):
+        if not 0 < tuning[key] < 1 - MIN_FREE_HEAP:
+            raise ValueError('{} fraction {} is out of range'.format(
+                key, tuning[key]))
+    heap_used = round(tuning['memstore'] + tuning['block_cache'], 6)
+    if heap_used > 1 - MIN_FREE_HEAP:
+        raise ValueError(
+            'memstore ({}) + block cache ({}) fractions exceed {}'.format(
+                tuning['memstore'], tuning['block_cache'],
+                1 - MIN_FREE_HEAP))
+
+    bucket_cache = config.get('bucket_cache_size', -1)
+    if bucket_cache < 0:
+        bucket_cache = 0
+        if tuning['bucket_cache']:
+            bucket_cache = int(
+                ram_mb * (1 - PAGE_CACHE_FRACTION) -
+                config['heap'] * HBASE_DAEMONS -
+                HADOOP_DAEMON_MB * hadoop_daemons - DIRECT_BUFFERS_MB)
+            if bucket_cache < 1024:
+                # Not worth the extra copy on every read.
+                bucket_cache = 0
+    tuning['bucket_cache'] = bucket_cache
+    # Direct memory must also cover the DFSClient and RPC buffers.
+    tuning['offheap'] = bucket_cache + DIRECT_BUFFERS_MB if bucket_cache else 0
+    return tuning
+
+
 class HBase(object):
     '''This class manages HBase.'''
     def __init__(self):
@@ -29,8 +189,36 @@ class HBase(object):
     def configure(self, hosts, zk_units):
         zk_connect = self.get_zk_connect(zk_units)
         roles = ['hbase-server', 'hbase-master', 'hbase-client']
+        tuning = memory_tuning(hookenv.config(),
+                               host.get_total_ram() // 1024 // 1024,
+                               hadoop_daemons_colocated())
+        hookenv.log('HBase memory tuning: {}'.format(tuning))
+        window = compaction_window(hookenv.config()['compaction_window'])
+        throughput = hookenv.config()['compaction_throughput'] * 1024 * 1024
         override = {
             'bigtop::hbase_thrift_port': self.dist_config.port('hbase-thrift'),
+            # With a window, major compactions only run when we schedule
+            # them (see schedule_compactions).
+            'hadoop_hbase::common_config::major_compaction_period':
+                0 if window else None,
+            'hadoop_hbase::common_config::offpeak_start_hour':
+                window[0] if window else None,
+            'hadoop_hbase::common_config::offpeak_end_hour':
+                window[1] if window else None,
+            'hadoop_hbase::common_config::compaction_throughput':
+                throughput or None,
+            'hadoop_hbase::common_config::memstore_size': tuning['memstore'],
+            'hadoop_hbase::common_config::block_cache_size':
+                tuning['block_cache'],
+            'hadoop_hbase::common_config::bucketcache_size':
+                tuning['bucket_cache'] or None,
+            'hadoop_hbase::common_config::offheap_size':
+                '{}m'.format(tuning['offheap']) if tuning['offheap'] else None,
+            # Read HDFS blocks straight from local disk when a DataNode
+            # runs alongside us.
+            'hadoop_hbase::common_config::hdfs_shortcut_reader_user':
+                'hbase' if datanode_colocated() else None,
+            'hadoop_hbase::common_config::hdfs_domain_socket_path': DN_SOCKET,
             'hadoop_hbase::client::thrift': True,
             'hadoop_hbase::common_config::heap_size': hookenv.config()['heap'],
             'hadoop_hbase::common_config::zookeeper_quorum': zk_connect,
@@ -51,35 +239,186 @@ class HBase(object):
 
     def update_regionservers(self, addrs, remove=False):
         '''
-        Each HBase unit in the cluster runs a RegionServer process. Ensure
-        all unit IP addresses are listed in the regionservers file.
+        Each HBase unit in the cluster runs a RegionServer process. Queue
+        unit IP addresses to be added to (or removed from) the regionservers
+        file; apply_regionservers() writes the queued changes.
+
+        Every call bumps the pending generation, so that a burst of peer
+        events is applied as a single update.
 
         @param: addrs List of IP addresses
         @param: remove Bool to add (False) or remove (True) unit IPs
         '''
         unit_kv = unitdata.kv()
-        kv_ips = unit_kv.get('regionservers', default=[])
+        pending = unit_kv.get('regionservers.pending', default={})
+        for ip in addrs:
+            pending[ip] = not remove
+        unit_kv.set('regionservers.pending', pending)
+        unit_kv.set('regionservers.generation',
+                    unit_kv.get('regionservers.generation', default=0) + 1)
 
-        # add/remove IPs from our list
-        if remove:
-            kv_ips = [ip for ip in kv_ips if ip not in addrs]
-        else:
-            kv_ips.extend(addrs)
+    def regionservers_pending(self):
+        '''Return True if there are queued regionservers changes.'''
+        unit_kv = unitdata.kv()
+        return (unit_kv.get('regionservers.generation', default=0) !=
+                unit_kv.get('regionservers.applied', default=0))
+
+    def apply_regionservers(self, force=False):
+        '''
+        Apply queued regionservers changes, at most once per debounce
+        window unless forced. The file is only rewritten when its contents
+        change.
+
+        :returns: True if the regionservers file was rewritten
+        '''
+        unit_kv = unitdata.kv()
+        generation = unit_kv.get('regionservers.generation', default=0)
+        if generation == unit_kv.get('regionservers.applied', default=0):
+            return False
+        last_applied = unit_kv.get('regionservers.applied_at', default=0)
+        if not force and time.time() - last_applied < REGIONSERVERS_DEBOUNCE:
+            hookenv.log('Deferring regionservers update to generation {}'
+                        .format(generation))
+            return False
+
+        kv_ips = set(unit_kv.get('regionservers', default=[]))
+        for ip, add in unit_kv.get('regionservers.pending',
+                                   default={}).items():
+            if add:
+                kv_ips.add(ip)
+            else:
+                kv_ips.discard(ip)
 
         # write regionservers file using a sorted, unique set of addrs
-        new_kv = sorted(set(kv_ips))
-        rs_file = Path('/etc/hbase/conf/regionservers')
-        rs_file.write_lines(
-            [
-                '# DO NOT EDIT',
-                '# This file is automatically managed by Juju',
-            ] + [ip for ip in new_kv],
-            append=False
-        )
-
-        # save the new kv IPs
+        new_kv = sorted(kv_ips)
+        rs_file = Path(REGIONSERVERS_FILE)
+        lines = [
+            '# DO NOT EDIT',
+            '# This file is automatically managed by Juju',
+        ] + new_kv
+        changed = not rs_file.exists() or rs_file.lines(retain=False) != lines
+        if changed:
+            rs_file.write_lines(lines, append=False)
+        hookenv.log('Applied regionservers generation {}: {}'.format(
+            generation, new_kv))
+
+        # save the new kv IPs and the generation they reflect
         unit_kv.set('regionservers', new_kv)
+        unit_kv.set('regionservers.pending', {})
+        unit_kv.set('regionservers.applied', generation)
+        unit_kv.set('regionservers.applied_at', time.time())
         unit_kv.flush(True)
+        return changed
+
+    def shell(self, *commands):
+        '''Run commands through the hbase shell, and return its output.'''
+        script = '\n'.join(commands + ('exit',)) + '\n'
+        return utils.run_as('hbase', 'hbase', 'shell',
+                            input=script.encode('utf8'),
+                            capture_output=True)
+
+    def live_regionservers(self):
+        '''Return the number of live RegionServers in the cluster.'''
+        output = self.shell("status 'simple'")
+        match = re.search(r'(\d+) (?:live )?servers', output)
+        return int(match.group(1)) if match else 0
+
+    def active_master(self):
+        '''Return the hostname of the active HMaster, or None.'''
+        output = self.shell("status 'simple'")
+        match = re.search(r'active master:\s*([^\s:,]+)', output)
+        return match.group(1) if match else None
+
+    def move_region(self, region, server=None):
+        '''
+        Move a region (by encoded name) to a server ('host,port,startcode'),
+        or to a random server if none is given.
+        '''
+        command = "move '{}'".format(region)
+        if server:
+            command += ", '{}'".format(server)
+        output = self.shell(command)
+        if 'ERROR' in output:
+            raise ValueError(output.strip())
+
+    def region_assignments(self, table):
+        '''
+        Return {server: [region start key, ...]} for a table, read from
+        hbase:meta.
+        '''
+        output = self.shell(
+            "scan 'hbase:meta', {{FILTER => \"PrefixFilter('{},')\", "
+            "COLUMNS => ['info:server']}}".format(table))
+        assignments = {}
+        for line in output.splitlines():
+            match = re.match(r'\s*{},(?P<start>.*?),\d+\.\S*\s+'
+                             r'column=info:server,.*value=(?P<server>\S+)'
+                             .format(re.escape(table)), line)
+            if match:
+                assignments.setdefault(match.group('server'), []).append(
+                    match.group('start'))
+        return assignments
+
+    def set_balancer(self, enabled):
+        '''
+        Switch the balancer on or off, and return whether it was on before.
+        '''
+        output = self.shell('balance_switch {}'.format(
+            'true' if enabled else 'false'))
+        for line in output.splitlines():
+            if line.strip() in ('true', 'false'):
+                return line.strip() == 'true'
+        return True
+
+    def balance(self):
+        '''
+        Run the balancer once. Returns False if the master declined to
+        balance (e.g. while regions are in transition).
+        '''
+        output = self.shell('balancer')
+        return any(line.strip() == 'true' for line in output.splitlines())
+
+    def decommission(self):
+        '''
+        Gracefully take our RegionServer out of the cluster: with the
+        balancer off, so regions are not handed straight back, move our
+        regions to the other RegionServers, then stop ours.
+        '''
+        hostname = subprocess.check_output(
+            ['hostname', '-f']).decode('utf8').strip()
+        balancer = self.set_balancer(False)
+        try:
+            hookenv.log('Moving regions off {}'.format(hostname))
+            utils.run_as('hbase', 'hbase', 'org.jruby.Main',
+                         '/usr/lib/hbase/bin/region_mover.rb',
+                         '--file={}'.format(
+                             os.path.join('/tmp', 'hbase-regions-unload')),
+                         'unload', hostname)
+        except subprocess.CalledProcessError as e:
+            hookenv.log('Unable to move regions off {}: {}'.format(
+                hostname, e), hookenv.WARNING)
+        finally:
+            host.service_stop('hbase-regionserver')
+            self.set_balancer(balancer)
+        hookenv.log('RegionServer decommissioned')
+
+    def schedule_compactions(self, window):
+        '''
+        Major-compact every table, one at a time, at the start of the
+        (start, end) window each day; or stop doing so if window is None.
+        '''
+        if not window:
+            if os.path.exists(COMPACT_CRON):
+                os.remove(COMPACT_CRON)
+            return
+        host.write_file(COMPACT_SCRIPT, open(os.path.join(
+            hookenv.charm_dir(), 'files', 'hbase-compact'), 'rb').read(),
+            perms=0o755)
+        start, end = window
+        host.write_file(COMPACT_CRON, (
+            '# Scheduled major compactions; managed by Juju.\n'
+            '0 {} * * * hbase {} --hours {} >/dev/null 2>&1\n'.format(
+                start, COMPACT_SCRIPT, (end - start) % 24)).encode('utf8'))
 
     def restart(self):
         self.stop()
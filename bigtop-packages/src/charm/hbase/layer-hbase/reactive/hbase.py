@@ -13,9 +13,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from charmhelpers.core import hookenv
+import os
+import subprocess
+
+from charmhelpers.core import hookenv, unitdata
 from charms.layer.apache_bigtop_base import get_layer_opts, get_package_version
-from charms.layer.bigtop_hbase import HBase
+from charms.layer.bigtop_hbase import (
+    REBALANCE_ATTEMPTS,
+    REGIONSERVERS_FILE,
+    HBase,
+    compaction_window,
+    datanode_colocated,
+    memory_tuning,
+    short_circuit_active
+)
 from charms.reactive import (
     RelationBase,
     is_state,
@@ -36,7 +47,11 @@ def report_status():
     zk_joined = is_state('zookeeper.joined')
     zk_ready = is_state('zookeeper.ready')
     hbase_installed = is_state('hbase.installed')
-    if not hadoop_joined:
+    config_error = get_config_error()
+    if config_error:
+        hookenv.status_set('blocked',
+                           'invalid config: {}'.format(config_error))
+    elif not hadoop_joined:
         hookenv.status_set('blocked',
                            'waiting for relation to hadoop plugin')
     elif not hdfs_ready:
@@ -51,11 +66,26 @@ def report_status():
     elif not hbase_installed:
         hookenv.status_set('waiting',
                            'waiting to install hbase')
+    elif short_circuit_active():
+        hookenv.status_set('active',
+                           'ready (short-circuit reads)')
     else:
         hookenv.status_set('active',
                            'ready')
 
 
+def get_config_error():
+    '''
+    Return why the memory tuning or compaction config is invalid, if it is.
+    '''
+    try:
+        memory_tuning(hookenv.config(), 0)
+        compaction_window(hookenv.config()['compaction_window'])
+    except ValueError as e:
+        return str(e)
+    return None
+
+
 @when('bigtop.available', 'hadoop.hdfs.ready', 'zookeeper.ready')
 def install_hbase(hdfs, zk):
     '''
@@ -64,9 +94,11 @@ def install_hbase(hdfs, zk):
     - initial install
     - config change
     - Zookeeper unit has joined/departed
+    - a DataNode has started (or stopped) on this machine
     '''
     zks = zk.zookeepers()
     deployment_matrix = {
+        'short_circuit': datanode_colocated(),
         'zookeepers': zks,
     }
 
@@ -90,6 +122,11 @@ def install_hbase(hdfs, zk):
                 data_changed('deployment_matrix', deployment_matrix)):
             return
 
+    # Refuse to render a config that HBase would fail to start with.
+    if get_config_error():
+        report_status()
+        return
+
     hookenv.status_set('maintenance', '{} hbase'.format(prefix))
     hookenv.log("{} hbase with: {}".format(prefix, deployment_matrix))
     hbase = HBase()
@@ -100,7 +137,8 @@ def install_hbase(hdfs, zk):
     # Ensure our IP is in the regionservers list; restart if the rs conf
     # file has changed.
     hbase.update_regionservers([hookenv.unit_private_ip()])
-    if any_file_changed(['/etc/hbase/conf/regionservers']):
+    hbase.apply_regionservers(force=True)
+    if any_file_changed([REGIONSERVERS_FILE]):
         hbase.restart()
 
     # set app version string for juju status output
@@ -109,6 +147,10 @@ def install_hbase(hdfs, zk):
 
     hbase.open_ports()
     report_status()
+    if prefix == 'installing':
+        # Give our new RegionServer its share of the regions.
+        unitdata.kv().set('hbase.rebalance.attempts', 0)
+        set_state('hbase.rebalance.pending')
     set_state('hbase.installed')
 
 
@@ -122,11 +164,25 @@ def stop_hbase():
     '''
     hbase = HBase()
     hbase.close_ports()
+    if is_departing_unit() and not is_state('hbase.decommissioned'):
+        # We are being removed; hand our regions over before stopping.
+        decommission(hbase)
     hbase.stop()
     remove_state('hbase.installed')
     report_status()
 
 
+def is_departing_unit():
+    '''Return True if this unit is the one leaving the relation.'''
+    return os.environ.get('JUJU_DEPARTING_UNIT') == hookenv.local_unit()
+
+
+def decommission(hbase):
+    hookenv.status_set('maintenance', 'decommissioning regionserver')
+    hbase.decommission()
+    set_state('hbase.decommissioned')
+
+
 @when('hbase.installed')
 @when_any('hbpeer.departed', 'hbpeer.joined')
 def handle_peers():
@@ -136,8 +192,15 @@ def handle_peers():
     a list of peer tuples, e.g.:
         [('hbase/0', '172.31.5.161'), ('hbase/2', '172.31.5.11')]
 
-    Depending on the state, this handler will add or remove peer IP addresses
-    from the regionservers config file.
+    Depending on the state, this handler will queue peer IP addresses to be
+    added to or removed from the regionservers config file. The queue is
+    applied by apply_regionservers, so a burst of peer events results in a
+    single update of the file.
+
+    RegionServers register themselves with Zookeeper, so the file does not
+    affect running services and nothing is restarted here. A new unit starts
+    its own RegionServer when it is installed; a unit that is being removed
+    moves its regions to the remaining RegionServers before stopping.
     '''
     if is_state('hbpeer.departed'):
         hbpeer = RelationBase.from_state('hbpeer.departed')
@@ -155,23 +218,85 @@ def handle_peers():
         hookenv.log('Ignoring unknown HBase peer state')
         return
 
-    hookenv.status_set('maintenance', message)
     hbase = HBase()
+    if (is_departing and is_departing_unit() and
+            not is_state('hbase.decommissioned')):
+        decommission(hbase)
+
+    hookenv.status_set('maintenance', message)
     ip_addrs = [node[1] for node in nodes]
     hookenv.log('{}: {}'.format(message, ip_addrs))
     hbase.update_regionservers(ip_addrs, remove=is_departing)
-
-    # NB: the rs conf file will always change when handling peer updates, but
-    # we still include this condition to keep the files_changed kv current.
-    if any_file_changed(['/etc/hbase/conf/regionservers']):
-        hbase.restart()
+    set_state('hbase.regionservers.pending')
 
     # Dismiss appropriate state now that we've handled the peer
     if is_departing:
         hbpeer.dismiss_departed()
     else:
         hbpeer.dismiss_joined()
-    report_status()
+    if is_state('hbase.decommissioned'):
+        hookenv.status_set('maintenance', 'regionserver decommissioned')
+    else:
+        report_status()
+
+
+@when('hbase.installed', 'hbase.regionservers.pending')
+def apply_regionservers():
+    '''
+    Write queued peer changes to the regionservers file, at most once per
+    hook and debounce window. Changes held back by the window are applied
+    on a later hook (at the latest, the next update-status).
+    '''
+    hbase = HBase()
+    hbase.apply_regionservers()
+    # Keep the files_changed kv current; nothing needs a restart, since
+    # RegionServers register themselves with Zookeeper.
+    any_file_changed([REGIONSERVERS_FILE])
+    if not hbase.regionservers_pending():
+        remove_state('hbase.regionservers.pending')
+
+
+@when('hbase.installed', 'hbase.rebalance.pending')
+@when_not('hbase.decommissioned')
+def rebalance():
+    '''
+    Run the balancer once our RegionServer has joined, so that it takes on
+    its share of the regions. The master declines to balance while regions
+    are in transition, or at all while the balancer is switched off; try
+    again on the next few hooks, then give up.
+    '''
+    try:
+        balanced = HBase().balance()
+    except subprocess.CalledProcessError as e:
+        hookenv.log('Unable to run the balancer: {}'.format(e),
+                    hookenv.WARNING)
+        balanced = False
+    unit_kv = unitdata.kv()
+    attempts = unit_kv.get('hbase.rebalance.attempts', default=0) + 1
+    if balanced:
+        remove_state('hbase.rebalance.pending')
+    elif attempts >= REBALANCE_ATTEMPTS:
+        hookenv.log('Balancer did not run after {} attempts; giving up. '
+                    'Check that it is switched on (balance_switch true) '
+                    'and run it from the hbase shell.'.format(attempts),
+                    hookenv.WARNING)
+        remove_state('hbase.rebalance.pending')
+    else:
+        hookenv.log('Balancer did not run; will try again on the next hook')
+    unit_kv.set('hbase.rebalance.attempts', attempts)
+
+
+@when('hbase.installed')
+def schedule_compactions():
+    '''
+    Only the leader schedules major compactions, so that tables are
+    compacted one at a time across the cluster.
+    '''
+    window = None
+    if is_state('leadership.is_leader') and not get_config_error():
+        window = compaction_window(hookenv.config()['compaction_window'])
+    if data_changed('hbase.compaction.schedule', window):
+        HBase().schedule_compactions(window)
 
 
 @when('hbase.installed', 'leadership.is_leader')
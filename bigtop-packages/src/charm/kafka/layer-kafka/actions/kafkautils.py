@@ -13,10 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import random
 import re
+import shlex
+import string
+import subprocess
 import sys
+import tempfile
+import time
 
 from charmhelpers.core import hookenv
+from charms.layer.apache_bigtop_base import get_layer_opts
 
 
 def fail(msg):
@@ -36,3 +44,368 @@ def get_zookeepers():
             return zks
 
     return None
+
+
+RESULT_DIR = '/opt/kafka-perf-results'
+
+PRODUCER_PERF_RE = re.compile(
+    r'(?P<records>\d+) records sent, '
+    r'(?P<records_sec>[\d.]+) records/sec \((?P<mb_sec>[\d.]+) MB/sec\), '
+    r'(?P<avg_latency>[\d.]+) ms avg latency, '
+    r'(?P<max_latency>[\d.]+) ms max latency, '
+    r'(?P<p50>\d+) ms 50th, (?P<p95>\d+) ms 95th, '
+    r'(?P<p99>\d+) ms 99th, (?P<p999>\d+) ms 99.9th')
+
+
+def get_broker():
+    host = subprocess.check_output(['hostname', '-s']).decode('utf8').strip()
+    port = get_layer_opts().port('kafka')
+    return '{}:{}'.format(host, port)
+
+
+def parse_producer_perf(output):
+    """
+    Parse the summary line of kafka-producer-perf-test.sh, e.g.:
+
+        1000 records sent, 4048.5 records/sec (0.39 MB/sec), 153.25 ms avg
+        latency, 241.00 ms max latency, 156 ms 50th, 230 ms 95th, 238 ms
+        99th, 241 ms 99.9th.
+
+    Returns a dict of floats, or None if there is no summary line.
+    """
+    matches = list(PRODUCER_PERF_RE.finditer(output))
+    if not matches:
+        return None
+    # The last match is the final summary; earlier ones are progress.
+    return {k: float(v) for k, v in matches[-1].groupdict().items()}
+
+
+def merge_producer_perf(results):
+    """
+    Combine the summaries of producers that ran side by side: rates and
+    record counts add up, the average latency is weighted by record
+    count, and we keep the worst of each maximum and percentile.
+    """
+    records = sum(r['records'] for r in results)
+    merged = {
+        'records': records,
+        'records_sec': sum(r['records_sec'] for r in results),
+        'mb_sec': sum(r['mb_sec'] for r in results),
+        'avg_latency': sum(r['avg_latency'] * r['records']
+                           for r in results) / records if records else 0,
+    }
+    for key in ('max_latency', 'p50', 'p95', 'p99', 'p999'):
+        merged[key] = max(r[key] for r in results)
+    return merged
+
+
+def parse_consumer_perf(output):
+    """
+    Parse kafka-consumer-perf-test.sh output, which is a CSV header line
+    followed by a line of values, e.g.:
+
+        start.time, end.time, data.consumed.in.MB, MB.sec,
+        data.consumed.in.nMsg, nMsg.sec
+        2017-03-01 10:00:00:000, 2017-03-01 10:00:05:000, 95.3674, 19.0735,
+        100000, 20000.0000
+
+    Returns a dict of the numeric fields, or None if they are missing.
+    """
+    lines = [line for line in output.splitlines() if ',' in line]
+    for i, line in enumerate(lines[:-1]):
+        if line.startswith('start.time'):
+            keys = [key.strip() for key in line.split(',')]
+            values = [value.strip() for value in lines[i + 1].split(',')]
+            results = {}
+            for key, value in zip(keys, values):
+                try:
+                    results[key] = float(value)
+                except ValueError:
+                    pass
+            return results
+    return None
+
+
+def save_result(name, output):
+    """
+    Keep the raw output of a perf run under RESULT_DIR/<name>, and
+    return the path of the log.
+    """
+    result_dir = os.path.join(RESULT_DIR, name)
+    os.makedirs(result_dir, exist_ok=True)
+    result_log = os.path.join(result_dir, '{}.log'.format(int(time.time())))
+    with open(result_log, 'w') as f:
+        f.write(output)
+    return result_log
+
+
+def benchmark(*args):
+    subprocess.check_call(['benchmark-{}'.format(args[0])] +
+                          [str(arg) for arg in args[1:]])
+
+
+KAFKA_BIN = '/usr/lib/kafka/bin'
+
+# Special offsets understood by GetOffsetShell and the simple consumer.
+LATEST = -1
+EARLIEST = -2
+
+
+def _as_kafka(*args):
+    """Return a command line that runs a kafka tool as the kafka user."""
+    return ['su', 'kafka', '-s', '/bin/bash', '-c',
+            ' '.join(shlex.quote(str(arg)) for arg in args)]
+
+
+def get_offset(topic, partition, when):
+    """
+    Return the offset of a partition at ``when``: LATEST for the log end
+    offset, EARLIEST for the first available offset, or a timestamp in
+    milliseconds. Timestamps resolve to the first offset of the newest
+    log segment created before that time.
+    """
+    output = subprocess.check_output(_as_kafka(
+        os.path.join(KAFKA_BIN, 'kafka-run-class.sh'),
+        'kafka.tools.GetOffsetShell',
+        '--broker-list', get_broker(),
+        '--topic', topic,
+        '--partitions', partition,
+        '--time', when,
+        '--max-num-offsets', 1), stderr=subprocess.STDOUT).decode('utf8')
+    # Output lines look like <topic>:<partition>:<offset>[,<offset>...]
+    for line in output.splitlines():
+        fields = line.strip().split(':')
+        if len(fields) == 3 and fields[0] == topic:
+            offsets = [int(o) for o in fields[2].split(',') if o]
+            if offsets:
+                return offsets[0]
+    raise ValueError('No offset for {}:{} at {}: {}'.format(
+        topic, partition, when, output))
+
+
+def read_messages(topic, partition, offset, max_messages, max_bytes):
+    """
+    Stream messages from a partition, starting at ``offset``, and stop
+    once ``max_messages`` or ``max_bytes`` is reached, whichever comes
+    first, or at the end of the log.
+
+    Returns (messages, next_offset), where next_offset is where to resume
+    reading to get the following page.
+    """
+    proc = subprocess.Popen(_as_kafka(
+        os.path.join(KAFKA_BIN, 'kafka-simple-consumer-shell.sh'),
+        '--broker-list', get_broker(),
+        '--topic', topic,
+        '--partition', partition,
+        '--offset', offset,
+        '--max-messages', max_messages,
+        '--print-offsets',
+        '--no-wait-at-logend'),
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    messages = []
+    size = 0
+    next_offset = offset
+    pending = None
+    try:
+        # Each message is preceded by a "next offset = N" line.
+        for line in proc.stdout:
+            line = line.decode('utf8', 'replace').rstrip('\n')
+            if pending is None:
+                if line.startswith('next offset = '):
+                    pending = int(line.split('=', 1)[1])
+                continue
+            if messages and size + len(line) > max_bytes:
+                break
+            messages.append(line)
+            size += len(line)
+            next_offset, pending = pending, None
+            if len(messages) >= max_messages or size >= max_bytes:
+                break
+    finally:
+        if proc.poll() is None:
+            proc.terminate()
+        proc.wait()
+    return messages, next_offset
+
+
+REBALANCE_DIR = '/opt/kafka-rebalance'
+
+DESCRIBE_RE = re.compile(
+    r'Topic:\s*(?P<topic>\S+)\s+Partition:\s*(?P<partition>\d+)\s+'
+    r'Leader:\s*(?P<leader>-?\d+)\s+Replicas:\s*(?P<replicas>[\d,]+)')
+
+
+def get_broker_ids():
+    """
+    Return the ids of the live brokers in this deployment. Broker ids are
+    the unit numbers of the kafka units, so we can derive them from our
+    own unit name and those of our peers.
+    """
+    units = [hookenv.local_unit()]
+    for rid in hookenv.relation_ids('kafkapeers'):
+        units.extend(hookenv.related_units(rid))
+    return sorted(set(int(unit.split('/')[1]) for unit in units))
+
+
+def parse_assignments(output):
+    """
+    Parse kafka-topics.sh --describe output into
+    {topic: {partition: [replica, ...]}}.
+    """
+    assignments = {}
+    for match in DESCRIBE_RE.finditer(output):
+        replicas = [int(r) for r in match.group('replicas').split(',')]
+        assignments.setdefault(match.group('topic'), {})[
+            int(match.group('partition'))] = replicas
+    return assignments
+
+
+def plan_reassignment(assignments, brokers):
+    """
+    Even out the number of replicas held by each of ``brokers`` while
+    moving as little data as possible. Replicas stay where they are
+    unless their broker is not in ``brokers`` or holds more than its
+    share; the freed slots go to the least loaded brokers. Replica order
+    (and so each partition's preferred leader) is kept; leaders are
+    evened out by a preferred replica election instead.
+
+    Raises ValueError if a partition has more replicas than there are
+    brokers, rather than lowering its replication factor.
+
+    Returns a reassignment plan in the kafka-reassign-partitions.sh
+    format, holding only the partitions that move.
+    """
+    brokers = sorted(brokers)
+    partitions = [(topic, partition, assignments[topic][partition])
+                  for topic in sorted(assignments)
+                  for partition in sorted(assignments[topic])]
+    for topic, partition, replicas in partitions:
+        if len(replicas) > len(brokers):
+            raise ValueError(
+                '{} partition {} has {} replicas, but only {} brokers are '
+                'available'.format(topic, partition, len(replicas),
+                                   len(brokers)))
+    if not partitions:
+        return {'version': 1, 'partitions': []}
+
+    # Keep the replicas on our brokers, and count what each one holds.
+    kept = dict(((topic, partition), [r for r in replicas if r in brokers])
+                for topic, partition, replicas in partitions)
+    load = dict((broker, 0) for broker in brokers)
+    for replicas in kept.values():
+        for replica in replicas:
+            load[replica] += 1
+    total = sum(len(replicas) for _, _, replicas in partitions)
+    share = -(-total // len(brokers))
+
+    # Take replicas off brokers holding more than their share; followers
+    # first, so that preferred leaders stay put where possible.
+    shed = dict((key, set()) for key in kept)
+    for broker in brokers:
+        for follower in (True, False):
+            for key, replicas in sorted(kept.items()):
+                if load[broker] <= share:
+                    break
+                if broker in replicas and \
+                        (replicas.index(broker) > 0) == follower:
+                    replicas.remove(broker)
+                    shed[key].add(broker)
+                    load[broker] -= 1
+
+    # Fill the free slots from the least loaded brokers.
+    moves = []
+    for topic, partition, replicas in partitions:
+        target = kept[(topic, partition)]
+        while len(target) < len(replicas):
+            candidates = [b for b in brokers if b not in target and
+                          b not in shed[(topic, partition)]] or \
+                [b for b in brokers if b not in target]
+            broker = min(candidates, key=lambda b: (load[b], b))
+            target.append(broker)
+            load[broker] += 1
+        if target != replicas:
+            moves.append({'topic': topic, 'partition': partition,
+                          'replicas': target})
+    return {'version': 1, 'partitions': moves}
+
+
+def parse_verify(output):
+    """
+    Count the partitions of a reassignment by status, from
+    kafka-reassign-partitions.sh --verify output.
+    """
+    status = {'completed': 0, 'in_progress': 0, 'failed': 0}
+    for line in output.splitlines():
+        if not line.startswith('Reassignment of partition'):
+            continue
+        if 'completed successfully' in line:
+            status['completed'] += 1
+        elif 'in progress' in line:
+            status['in_progress'] += 1
+        elif 'failed' in line:
+            status['failed'] += 1
+    return status
+
+
+def synthetic_records(count, size, distribution='fixed'):
+    """
+    Generate ``count`` printable records averaging ``size`` bytes. With
+    the "uniform" distribution, sizes vary evenly between half and one and
+    a half times ``size``; with "normal", they follow a bell curve around
+    it.
+    """
+    # Slice records out of one random buffer rather than building each
+    # one character by character; this keeps up with the producer.
+    buf = ''.join(random.choice(string.ascii_letters + string.digits)
+                  for _ in range(size * 4))
+    for _ in range(count):
+        if distribution == 'uniform':
+            length = random.randint(max(size // 2, 1), size * 3 // 2)
+        elif distribution == 'normal':
+            length = int(random.gauss(size, size / 4.0))
+        else:
+            length = size
+        length = min(max(length, 1), len(buf))
+        start = random.randrange(len(buf) - length + 1)
+        yield buf[start:start + length]
+
+
+def produce(topic, records, linger_ms=5, batch_size=16384, acks='1'):
+    """
+    Send an iterable of records to a topic through a single console
+    producer, so the JVM starts once and the producer batches records
+    (up to ``batch_size`` bytes per partition, waiting up to ``linger_ms``
+    for a batch to fill).
+
+    Returns (records, bytes, seconds).
+    """
+    # Collect stderr in a file: a pipe that is only read once all of the
+    # records are written would fill up if the producer logs a lot (e.g.
+    # retry warnings), and block it.
+    with tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(_as_kafka(
+            'kafka-console-producer.sh',
+            '--broker-list', get_broker(),
+            '--topic', topic,
+            '--timeout', linger_ms,
+            '--max-partition-memory-bytes', batch_size,
+            '--request-required-acks', acks),
+            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=err)
+        count = size = 0
+        start = time.time()
+        try:
+            for record in records:
+                data = record.rstrip('\n').encode('utf8') + b'\n'
+                proc.stdin.write(data)
+                count += 1
+                size += len(data) - 1
+        except BrokenPipeError:
+            pass
+        proc.communicate()
+        elapsed = time.time() - start
+        if proc.returncode:
+            err.seek(0)
+            raise subprocess.CalledProcessError(
+                proc.returncode, 'kafka-console-producer.sh',
+                err.read().decode('utf8', 'replace'))
+    return count, size, elapsed
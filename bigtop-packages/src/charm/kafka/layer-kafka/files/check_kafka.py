@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Check Kafka Broker
+
+Scrapes a curated set of broker MBeans over JMX, using the JmxTool that
+ships with Kafka, and reports them for Nagios or Prometheus.
+
+    check_kafka.py                                  # dump all metrics
+    check_kafka.py -o nagios -k under_replicated_partitions -w 1 -c 10
+    check_kafka.py -o prometheus                    # print once
+    check_kafka.py -o prometheus --listen 9308      # serve /metrics
+
+"""
+
+import csv
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+KAFKA_RUN_CLASS = '/usr/lib/kafka/bin/kafka-run-class.sh'
+
+# metric name -> (mbean, attribute)
+METRICS = {
+    'under_replicated_partitions': (
+        'kafka.server:type=ReplicaManager,name=UnderReplicatedPartitions',
+        'Value'),
+    'offline_partitions': (
+        'kafka.controller:type=KafkaController,name=OfflinePartitionsCount',
+        'Value'),
+    'active_controller': (
+        'kafka.controller:type=KafkaController,name=ActiveControllerCount',
+        'Value'),
+    'isr_shrinks_per_sec': (
+        'kafka.server:type=ReplicaManager,name=IsrShrinksPerSec',
+        'OneMinuteRate'),
+    'messages_in_per_sec': (
+        'kafka.server:type=BrokerTopicMetrics,name=MessagesInPerSec',
+        'OneMinuteRate'),
+    'bytes_in_per_sec': (
+        'kafka.server:type=BrokerTopicMetrics,name=BytesInPerSec',
+        'OneMinuteRate'),
+    'bytes_out_per_sec': (
+        'kafka.server:type=BrokerTopicMetrics,name=BytesOutPerSec',
+        'OneMinuteRate'),
+    'produce_total_time_ms': (
+        'kafka.network:type=RequestMetrics,name=TotalTimeMs,request=Produce',
+        '99thPercentile'),
+    'fetch_total_time_ms': (
+        'kafka.network:type=RequestMetrics,name=TotalTimeMs,'
+        'request=FetchConsumer',
+        '99thPercentile'),
+    'request_queue_time_ms': (
+        'kafka.network:type=RequestMetrics,name=RequestQueueTimeMs,'
+        'request=Produce',
+        '99thPercentile'),
+    'request_queue_size': (
+        'kafka.network:type=RequestChannel,name=RequestQueueSize',
+        'Value'),
+}
+
+
+def get_metrics(port, timeout=60):
+    """
+    Return {metric: value} for every metric the broker exposes. JmxTool
+    prints a CSV header and then a row of values every reporting interval;
+    we only need the first row.
+    """
+    cmd = [KAFKA_RUN_CLASS, 'kafka.tools.JmxTool',
+           '--jmx-url',
+           'service:jmx:rmi:///jndi/rmi://localhost:{}/jmxrmi'.format(port),
+           '--reporting-interval', '1000']
+    for mbean, _ in sorted(set(METRICS.values())):
+        cmd.extend(['--object-name', mbean])
+    env = dict(os.environ)
+    # JMX_PORT would make the JmxTool JVM try to bind the broker's port.
+    env.pop('JMX_PORT', None)
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL,
+                            universal_newlines=True)
+    # Kill JmxTool at the deadline even if it never prints anything; that
+    # ends the read loop below.
+    watchdog = threading.Timer(timeout, proc.kill)
+    watchdog.start()
+    lines = []
+    try:
+        for line in proc.stdout:
+            if line.startswith('"time"') or lines:
+                lines.append(line)
+            if len(lines) == 2:
+                break
+    finally:
+        watchdog.cancel()
+        proc.kill()
+        proc.wait()
+    if len(lines) < 2:
+        raise RuntimeError('No data from JMX on port {}'.format(port))
+
+    header, values = csv.reader(lines)
+    row = dict(zip(header, values))
+    metrics = {}
+    for name, (mbean, attribute) in METRICS.items():
+        value = row.get('{}:{}'.format(mbean, attribute))
+        if value not in (None, ''):
+            metrics[name] = float(value)
+    return metrics
+
+
+class NagiosHandler(object):
+
+    @classmethod
+    def register_options(cls, parser):
+        group = parser.add_argument_group('Nagios specific options')
+        group.add_argument('-w', '--warning', type=float)
+        group.add_argument('-c', '--critical', type=float)
+
+    def analyze(self, opts):
+        if opts.key is None or opts.warning is None or opts.critical is None:
+            print('You should specify a key, warning and critical.',
+                  file=sys.stderr)
+            return 3
+        try:
+            value = get_metrics(opts.port)[opts.key]
+        except KeyError:
+            print('Unknown "{}": not exposed by the broker'.format(opts.key))
+            return 3
+        except Exception as e:
+            print('Critical: cannot read broker metrics: {}'.format(e))
+            return 2
+
+        perf = '{}={};{};{}'.format(opts.key, value, opts.warning,
+                                    opts.critical)
+        if value >= opts.critical:
+            print('Critical "{}" is {}!|{}'.format(opts.key, value, perf))
+            return 2
+        elif value >= opts.warning:
+            print('Warning "{}" is {}!|{}'.format(opts.key, value, perf))
+            return 1
+        print('Ok "{}" is {}|{}'.format(opts.key, value, perf))
+        return 0
+
+
+class PrometheusHandler(object):
+
+    @classmethod
+    def register_options(cls, parser):
+        group = parser.add_argument_group('Prometheus specific options')
+        group.add_argument('--listen', type=int,
+                           help='serve /metrics on this port')
+        group.add_argument('--cache', type=int, default=15,
+                           help='seconds to reuse a scrape for (default 15)')
+
+    @staticmethod
+    def render(metrics):
+        lines = []
+        for name in sorted(metrics):
+            mbean, attribute = METRICS[name]
+            lines.append('# HELP kafka_{} {} {}'.format(name, mbean,
+                                                        attribute))
+            lines.append('# TYPE kafka_{} gauge'.format(name))
+            lines.append('kafka_{} {}'.format(name, metrics[name]))
+        return '\n'.join(lines) + '\n'
+
+    def analyze(self, opts):
+        if not opts.listen:
+            sys.stdout.write(self.render(get_metrics(opts.port)))
+            return 0
+
+        # Each scrape starts a JVM, so share one between close requests.
+        cache = {'time': 0, 'body': ''}
+        render = self.render
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                try:
+                    if time.time() - cache['time'] > opts.cache:
+                        cache['body'] = render(get_metrics(opts.port))
+                        cache['time'] = time.time()
+                except Exception as e:
+                    self.send_error(503, str(e))
+                    return
+                body = cache['body'].encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        HTTPServer(('', opts.listen), MetricsHandler).serve_forever()
+
+
+def create_handler(name):
+    """ Return an instance of a platform specific analyzer """
+    try:
+        return globals()['%sHandler' % name.capitalize()]()
+    except KeyError:
+        return None
+
+
+def get_all_handlers():
+    """ Get a list containing all the platform specific analyzers """
+    return [NagiosHandler, PrometheusHandler]
+
+
+def parse_cli():
+    parser = ArgumentParser(description='Check Kafka broker metrics')
+    parser.add_argument('-p', '--port', type=int, default=9999,
+                        help='broker JMX port (default 9999)')
+    parser.add_argument('-o', '--output', choices=['nagios', 'prometheus'],
+                        help='output format; dumps all metrics if unset')
+    parser.add_argument('-k', '--key', choices=sorted(METRICS),
+                        help='metric to check')
+    for handler in get_all_handlers():
+        handler.register_options(parser)
+    return parser.parse_args()
+
+
+def main():
+    opts = parse_cli()
+    if opts.output is None:
+        for name, value in sorted(get_metrics(opts.port).items()):
+            print('%30s  %s' % (name, value))
+        return 0
+    return create_handler(opts.output).analyze(opts)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,8 +14,11 @@
 # limitations under the License.
 
 import os
+import re
 import shutil
-from subprocess import check_output
+import socket
+import time
+from subprocess import check_call, check_output
 
 from charmhelpers.core import hookenv
 from charmhelpers.core import host
@@ -24,6 +27,59 @@ from charms.layer.apache_bigtop_base import Bigtop
 from charms import layer
 
 
+# Charm config options that override the derived tuning profile; the
+# value 0 means "derive from the hardware".
+TUNING_OPTIONS = {
+    'num_network_threads': 'num.network.threads',
+    'num_io_threads': 'num.io.threads',
+    'num_replica_fetchers': 'num.replica.fetchers',
+    'socket_buffer_bytes': 'socket.buffer.bytes',
+    'log_segment_bytes': 'log.segment.bytes',
+    'heap_size': 'heap.mb',
+}
+
+
+def tuning_profile(cores, ram_mb, disks, config=None):
+    """
+    Derive broker tuning from the size of the machine.
+
+    Network threads scale with cores; io threads scale with cores and the
+    number of log disks so that every disk has requests in flight. The
+    heap gets a quarter of RAM, capped at 6G: kafka relies on the page
+    cache, not the heap, to serve reads. Anything set in ``config`` wins.
+    """
+    disks = max(disks, 1)
+    profile = {
+        'num.network.threads': max(3, cores // 2),
+        'num.io.threads': max(8, cores, disks * 4),
+        'num.replica.fetchers': max(1, min(cores // 4, 8)),
+        'socket.buffer.bytes': 1048576 if ram_mb < 16384 else 2097152,
+        'log.segment.bytes': 536870912 if ram_mb < 8192 else 1073741824,
+        'heap.mb': max(512, min(ram_mb // 4, 6144)),
+    }
+    for option, key in TUNING_OPTIONS.items():
+        if config and config.get(option):
+            profile[key] = int(config[option])
+    return profile
+
+
+NAGIOS_PLUGINS = '/usr/local/lib/nagios/plugins'
+METRICS_SERVICE = '/etc/systemd/system/kafka-metrics.service'
+# e.g. "Topic: t  Partition: 0  Leader: 1  Replicas: 1,2  Isr: 1"
+REPLICAS_RE = re.compile(r'Replicas:\s*(?P<replicas>[\d,]+)\s+'
+                         r'Isr:\s*(?P<isr>[\d,]*)')
+
+
+def zk_connect(zk_units):
+    """Return the zookeeper connection string for our zookeeper units."""
+    zks = []
+    for unit in zk_units:
+        ip = utils.resolve_private_address(unit['host'])
+        zks.append("%s:%s" % (ip, unit['port']))
+    zks.sort()
+    return ",".join(zks)
+
+
 class Kafka(object):
     """
     This class manages Kafka.
@@ -40,14 +96,15 @@ class Kafka(object):
         for port in self.dist_config.exposed_ports('kafka'):
             hookenv.close_port(port)
 
-    def configure_kafka(self, zk_units, network_interface=None, log_dir=None):
+    def tuning(self, log_dirs=None):
+        """Return the tuning profile for this machine and charm config."""
+        ram_mb = host.get_total_ram() // 1024 // 1024
+        return tuning_profile(os.cpu_count() or 1, ram_mb,
+                              len(log_dirs or []), hookenv.config())
+
+    def configure_kafka(self, zk_units, network_interface=None, log_dirs=None):
         # Get ip:port data from our connected zookeepers
-        zks = []
-        for unit in zk_units:
-            ip = utils.resolve_private_address(unit['host'])
-            zks.append("%s:%s" % (ip, unit['port']))
-        zks.sort()
-        zk_connect = ",".join(zks)
+        zk_connect_string = zk_connect(zk_units)
         service, unit_num = os.environ['JUJU_UNIT_NAME'].split('/', 1)
         kafka_port = self.dist_config.port('kafka')
 
@@ -55,9 +112,26 @@ class Kafka(object):
         override = {
             'kafka::server::broker_id': unit_num,
             'kafka::server::port': kafka_port,
-            'kafka::server::zookeeper_connection_string': zk_connect,
-            'kafka::server::log_dirs': log_dir,
+            'kafka::server::zookeeper_connection_string': zk_connect_string,
+            'kafka::server::log_dirs': ','.join(log_dirs) if log_dirs else None,
         }
+        tuning = self.tuning(log_dirs)
+        hookenv.log('Kafka tuning profile: {}'.format(tuning))
+        override.update({
+            'kafka::server::num_network_threads':
+                tuning['num.network.threads'],
+            'kafka::server::num_io_threads': tuning['num.io.threads'],
+            'kafka::server::num_replica_fetchers':
+                tuning['num.replica.fetchers'],
+            'kafka::server::socket_send_buffer_bytes':
+                tuning['socket.buffer.bytes'],
+            'kafka::server::socket_receive_buffer_bytes':
+                tuning['socket.buffer.bytes'],
+            'kafka::server::log_segment_bytes': tuning['log.segment.bytes'],
+            'kafka::server::heap_opts': '-Xms{0}m -Xmx{0}m'.format(
+                tuning['heap.mb']),
+            'kafka::server::jmx_port': self.dist_config.port('kafka-jmx'),
+        })
         if network_interface:
             ip = Bigtop().get_ip_for_interface(network_interface)
             override['kafka::server::bind_addr'] = ip
@@ -66,7 +140,8 @@ class Kafka(object):
         bigtop.render_site_yaml(roles=roles, overrides=override)
         bigtop.trigger_puppet()
 
-        if log_dir:
+        # One log dir per attached disk; kafka spreads partitions across them.
+        for log_dir in log_dirs or []:
             os.makedirs(log_dir, mode=0o700, exist_ok=True)
             shutil.chown(log_dir, user='kafka')
 
@@ -83,6 +158,114 @@ class Kafka(object):
     def stop(self):
         host.service_stop('kafka-server')
 
+    def wait_for_broker(self, network_interface=None, timeout=120,
+                        interval=2):
+        """
+        Wait for the broker to accept connections again after a restart.
+        Return False if it is not up within ``timeout`` seconds.
+        """
+        addr = 'localhost'
+        if network_interface:
+            addr = Bigtop().get_ip_for_interface(network_interface)
+        port = self.dist_config.port('kafka')
+        deadline = time.time() + timeout
+        while True:
+            try:
+                socket.create_connection((addr, port), interval).close()
+                return True
+            except (OSError, socket.error):
+                if time.time() >= deadline:
+                    return False
+                time.sleep(interval)
+
+    def under_replicated_partitions(self, zk_units, broker_id=None):
+        """
+        Return the number of partitions with replicas out of the ISR. With
+        ``broker_id``, only count partitions whose replica on that broker
+        is out of the ISR, so that other brokers being down or removed do
+        not count.
+        """
+        output = utils.run_as('kafka', 'kafka-topics.sh',
+                              '--zookeeper', zk_connect(zk_units),
+                              '--describe', '--under-replicated-partitions',
+                              capture_output=True)
+        count = 0
+        for line in output.splitlines():
+            match = REPLICAS_RE.search(line)
+            if not match:
+                continue
+            if broker_id is not None:
+                replicas = match.group('replicas').split(',')
+                isr = match.group('isr').split(',')
+                if str(broker_id) not in replicas or str(broker_id) in isr:
+                    continue
+            count += 1
+        return count
+
+    def wait_for_isr(self, zk_units, broker_id=None, timeout=300,
+                     interval=5):
+        """
+        Wait until the replicas on this broker (or, without ``broker_id``,
+        on every broker) have caught up and rejoined the ISR. Return False
+        if they have not after ``timeout`` seconds.
+        """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                count = self.under_replicated_partitions(zk_units, broker_id)
+            except Exception as e:
+                hookenv.log('Unable to describe topics: {}'.format(e),
+                            hookenv.WARNING)
+                count = None
+            if count == 0:
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(interval)
+
+    def install_check(self):
+        """Install the JMX collector used by nagios and prometheus."""
+        os.makedirs(NAGIOS_PLUGINS, exist_ok=True)
+        dst = os.path.join(NAGIOS_PLUGINS, 'check_kafka.py')
+        shutil.copy(os.path.join(hookenv.charm_dir(), 'files',
+                                 'check_kafka.py'), dst)
+        os.chmod(dst, 0o755)
+        return dst
+
+    def configure_metrics(self, enabled):
+        """
+        Serve broker metrics for prometheus on the kafka-metrics port, by
+        running the collector as a service.
+        """
+        if not enabled:
+            if os.path.exists(METRICS_SERVICE):
+                host.service_stop('kafka-metrics')
+                os.remove(METRICS_SERVICE)
+                check_call(['systemctl', 'daemon-reload'])
+            hookenv.close_port(self.dist_config.port('kafka-metrics'))
+            return
+
+        check = self.install_check()
+        host.write_file(METRICS_SERVICE, '\n'.join([
+            '[Unit]',
+            'Description=Kafka broker metrics for prometheus',
+            'After=kafka-server.service',
+            '',
+            '[Service]',
+            'User=kafka',
+            'ExecStart={} -o prometheus -p {} --listen {}'.format(
+                check, self.dist_config.port('kafka-jmx'),
+                self.dist_config.port('kafka-metrics')),
+            'Restart=always',
+            '',
+            '[Install]',
+            'WantedBy=multi-user.target',
+            '']).encode('utf8'))
+        check_call(['systemctl', 'daemon-reload'])
+        check_call(['systemctl', 'enable', 'kafka-metrics'])
+        host.service_restart('kafka-metrics')
+        hookenv.open_port(self.dist_config.port('kafka-metrics'))
+
     def set_advertise(self):
         short_host = check_output(['hostname', '-s']).decode('utf8').strip()
 
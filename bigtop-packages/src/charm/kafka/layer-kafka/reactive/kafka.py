@@ -13,14 +13,90 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
+import time
 
 from charmhelpers.core import hookenv, unitdata
 from charms.layer.apache_bigtop_base import get_layer_opts, get_package_version
-from charms.layer.bigtop_kafka import Kafka
-from charms.reactive import set_state, remove_state, when, when_not, hook
+from charms.layer.bigtop_kafka import Kafka, TUNING_OPTIONS
+from charms.leadership import leader_get, leader_set
+from charms.reactive import (set_state, remove_state, is_state, when,
+                             when_not, hook)
 from charms.reactive.helpers import data_changed
 
+# Hooks (each waiting up to 5 minutes) to wait for our replicas to rejoin
+# the ISR after a rolling restart before moving on to the next broker.
+ISR_CHECKS = 6
+
+
+@when('local-monitors.available')
+def local_monitors_available(nagios):
+    setup_nagios(nagios)
+
+
+@when('nrpe-external-master.available')
+def nrpe_external_master_available(nagios):
+    setup_nagios(nagios)
+
+
+def setup_nagios(nagios):
+    config = hookenv.config()
+    unit_name = hookenv.local_unit()
+    checks = [
+        {
+            'name': 'under_replicated_partitions',
+            'description': 'Kafka_Under_Replicated_Partitions',
+            'warn': config['under_replicated_partitions_warn'],
+            'crit': config['under_replicated_partitions_crit']
+        },
+        {
+            'name': 'offline_partitions',
+            'description': 'Kafka_Offline_Partitions',
+            'warn': 1,
+            'crit': 1
+        },
+        {
+            'name': 'request_queue_time_ms',
+            'description': 'Kafka_Request_Queue_Time',
+            'warn': config['request_queue_time_warn'],
+            'crit': config['request_queue_time_crit']
+        },
+    ]
+    check_cmd = ['/usr/local/lib/nagios/plugins/check_kafka.py',
+                 '-o', 'nagios',
+                 '-p', str(get_layer_opts().port('kafka-jmx'))]
+    for check in checks:
+        nagios.add_check(check_cmd + ['--key', check['name'],
+                                      '-w', str(check['warn']),
+                                      '-c', str(check['crit'])],
+                         name='kafka_{}'.format(check['name']),
+                         description=check['description'],
+                         context=config["nagios_context"],
+                         servicegroups=config["nagios_servicegroups"],
+                         unit=unit_name
+                         )
+    nagios.updated()
+
+
+@hook('upgrade-charm')
+def metrics_upgrade_charm():
+    # Make sure the collector will get replaced at charm upgrade
+    remove_state('kafka.metrics.configured')
+
+
+@when('kafka.started')
+def configure_metrics():
+    enabled = hookenv.config().get('prometheus_metrics')
+    if is_state('kafka.metrics.configured') and not data_changed(
+            'kafka.prometheus_metrics', enabled):
+        return
+    data_changed('kafka.prometheus_metrics', enabled)
+    kafka = Kafka()
+    kafka.install_check()
+    kafka.configure_metrics(enabled)
+    set_state('kafka.metrics.configured')
+
 
 @when('bigtop.available')
 @when_not('zookeeper.joined')
@@ -40,11 +116,13 @@ def configure_kafka(zk):
     hookenv.status_set('maintenance', 'setting up kafka')
     data_changed(  # Prime data changed for network interface
         'kafka.network_interface', hookenv.config().get('network_interface'))
-    log_dir = unitdata.kv().get('kafka.storage.log_dir')
-    data_changed('kafka.storage.log_dir', log_dir)
+    data_changed('kafka.tuning', get_tuning_config())
+    data_changed('kafka.jmx_port', get_layer_opts().port('kafka-jmx'))
+    log_dirs = get_log_dirs()
+    data_changed('kafka.storage.log_dirs', log_dirs)
     kafka = Kafka()
     zks = zk.zookeepers()
-    kafka.configure_kafka(zks, log_dir=log_dir)
+    kafka.configure_kafka(zks, log_dirs=log_dirs)
     kafka.open_ports()
     set_state('kafka.started')
     hookenv.status_set('active', 'ready')
@@ -61,23 +139,34 @@ def configure_kafka_zookeepers(zk):
     changes, restart Kafka and set appropriate status messages.
 
     This method also handles the restart if our network_interface
-    config has changed.
+    or tuning config has changed.
+
+    With peers, the reconfiguration is not applied here: restarting
+    every broker at once takes partitions offline, so we ask the leader
+    for a turn in a rolling restart instead (see `rolling_restart`).
 
     """
     zks = zk.zookeepers()
     network_interface = hookenv.config().get('network_interface')
-    log_dir = unitdata.kv().get('kafka.storage.log_dir')
+    log_dirs = get_log_dirs()
     if not(any((
             data_changed('zookeepers', zks),
             data_changed('kafka.network_interface', network_interface),
-            data_changed('kafka.storage.log_dir', log_dir)))):
+            data_changed('kafka.storage.log_dirs', log_dirs),
+            data_changed('kafka.tuning', get_tuning_config()),
+            data_changed('kafka.jmx_port',
+                         get_layer_opts().port('kafka-jmx'))))):
+        return
+
+    if _peers():
+        _request_restart()
         return
 
     hookenv.log('Checking Zookeeper configuration')
     hookenv.status_set('maintenance', 'updating zookeeper instances')
     kafka = Kafka()
     kafka.configure_kafka(zks, network_interface=network_interface,
-                          log_dir=log_dir)
+                          log_dirs=log_dirs)
     hookenv.status_set('active', 'ready')
 
 
@@ -100,22 +189,234 @@ def serve_client(client, zookeeper):
     hookenv.log('Sent Kafka configuration to client')
 
 
+# Rolling restart
+#
+# Brokers are restarted one at a time, and the next broker only restarts
+# once every partition is fully replicated again:
+#
+# 1. A broker whose configuration changed records a restart request (a
+#    timestamp) in its unit data and on the kafkapeers relation, and sets
+#    kafka.restart.requested.
+#
+# 2. The Juju leader keeps a queue of [unit, request] pairs in the
+#    "restart_queue" leadership data, in the order requests arrived.
+#
+# 3. The broker at the head of the queue applies its new configuration
+#    (re-running puppet and restarting kafka), waits for kafka to accept
+#    connections again, and then for under-replicated partitions to drop
+#    to zero. It then publishes "restart_done" (its request) and how long
+#    it was down and took to recover.
+#
+# 4. The leader pops finished requests off the queue, releasing the next
+#    broker, and records each broker's timing in the "restart_report"
+#    leadership data.
+#
+# The queue only ever holds outstanding requests, so a new leader picks up
+# where the old one left off, and departed brokers simply drop out.
+
+
+def _peers():
+    """Return (relation id, unit) pairs for each of our peers."""
+    return [(rid, unit)
+            for rid in hookenv.relation_ids('kafkapeers')
+            for unit in hookenv.related_units(rid)]
+
+
+def _request_restart():
+    request = str(time.time())
+    hookenv.log('Requesting rolling restart {}'.format(request))
+    unitdata.kv().set('kafka.restart_request', request)
+    for rid in hookenv.relation_ids('kafkapeers'):
+        hookenv.relation_set(rid, {'restart_request': request})
+    set_state('kafka.restart.requested')
+    hookenv.status_set('waiting', 'waiting for rolling restart')
+
+
+def _restart_requests():
+    """
+    Return {unit: {'request', 'done', 'timing'}} for every broker,
+    including ourselves.
+    """
+    kv = unitdata.kv()
+    requests = {hookenv.local_unit(): {
+        'request': kv.get('kafka.restart_request'),
+        'done': kv.get('kafka.restart_done'),
+        'timing': kv.get('kafka.restart_timing'),
+    }}
+    for rid, unit in _peers():
+        data = hookenv.relation_get(rid=rid, unit=unit) or {}
+        timing = data.get('restart_timing')
+        requests[unit] = {
+            'request': data.get('restart_request'),
+            'done': data.get('restart_done'),
+            'timing': json.loads(timing) if timing else None,
+        }
+    return requests
+
+
+@when('leadership.is_leader')
+def update_restart_queue():
+    """
+    Drop finished (or departed) requests from the restart queue, and
+    append new ones.
+    """
+    queue = json.loads(leader_get('restart_queue') or '[]')
+    requests = _restart_requests()
+    report = json.loads(leader_get('restart_report') or '{}')
+    if not queue:
+        report = {}
+
+    new_queue = []
+    for unit, request in queue:
+        current = requests.get(unit)
+        if not current or current['request'] != request:
+            # Departed, or superseded by a newer request (appended below).
+            continue
+        if current['done'] == request:
+            report[unit] = current['timing']
+            continue
+        new_queue.append([unit, request])
+    queued = [unit for unit, _ in new_queue]
+    for unit, current in sorted(requests.items()):
+        if (current['request'] and current['request'] != current['done'] and
+                unit not in queued):
+            new_queue.append([unit, current['request']])
+
+    if new_queue == queue:
+        return
+    if queue and not new_queue:
+        hookenv.log('Rolling restart complete: brokers down for {}s in '
+                    'total'.format(round(sum(
+                        t['downtime'] for t in report.values() if t), 3)))
+    hookenv.log('Leader updating restart queue: {}'.format(new_queue))
+    leader_set(restart_queue=json.dumps(new_queue),
+               restart_report=json.dumps(report))
+
+
+@when('kafka.started', 'zookeeper.ready', 'kafka.restart.requested')
+def rolling_restart(zk):
+    """
+    If it is our turn in the rolling restart, apply our new configuration
+    and wait for the partitions on this broker to be back in sync before
+    releasing the next broker.
+
+    If they have not caught up after ISR_CHECKS hooks, give up waiting and
+    release the queue anyway, so that one lagging broker does not hold up
+    the rest; our status says so until the replicas catch up.
+    """
+    kv = unitdata.kv()
+    request = kv.get('kafka.restart_request')
+    queue = json.loads(leader_get('restart_queue') or '[]')
+    if not queue or queue[0] != [hookenv.local_unit(), request]:
+        hookenv.status_set('waiting', 'waiting for rolling restart')
+        return
+
+    kafka = Kafka()
+    zks = zk.zookeepers()
+    network_interface = hookenv.config().get('network_interface')
+    restart = kv.get('kafka.restart')
+    if not restart or restart['request'] != request:
+        hookenv.status_set('maintenance', 'rolling restart')
+        started = time.time()
+        kafka.configure_kafka(zks, network_interface=network_interface,
+                              log_dirs=get_log_dirs())
+        if not kafka.wait_for_broker(network_interface):
+            hookenv.log('Kafka is not accepting connections yet',
+                        hookenv.WARNING)
+        restart = {
+            'request': request,
+            'downtime': round(time.time() - started, 3),
+            'restarted': time.time(),
+        }
+        kv.set('kafka.restart', restart)
+
+    hookenv.status_set('maintenance', 'waiting for partitions to catch up')
+    broker_id = hookenv.local_unit().split('/')[1]
+    caught_up = kafka.wait_for_isr(zks, broker_id)
+    if not caught_up:
+        restart['checks'] = restart.get('checks', 0) + 1
+        kv.set('kafka.restart', restart)
+        if restart['checks'] < ISR_CHECKS:
+            hookenv.log('Partitions are still under-replicated; '
+                        'will check again on the next hook.',
+                        hookenv.WARNING)
+            hookenv.status_set('waiting',
+                               'waiting for partitions to catch up')
+            return
+        hookenv.log('Partitions still under-replicated after {} checks; '
+                    'releasing the rolling restart'.format(ISR_CHECKS),
+                    hookenv.WARNING)
+
+    timing = {
+        'downtime': restart['downtime'],
+        'recovery': round(time.time() - restart['restarted'], 3),
+    }
+    hookenv.log('Rolling restart done: {}'.format(timing))
+    kv.set('kafka.restart_done', request)
+    kv.set('kafka.restart_timing', timing)
+    kv.unset('kafka.restart')
+    for rid in hookenv.relation_ids('kafkapeers'):
+        hookenv.relation_set(rid, {
+            'restart_done': request,
+            'restart_timing': json.dumps(timing),
+        })
+    remove_state('kafka.restart.requested')
+    if caught_up:
+        hookenv.status_set('active', 'ready')
+    else:
+        hookenv.status_set('active', 'ready (partitions under-replicated '
+                                     'after restart)')
+    if is_state('leadership.is_leader'):
+        update_restart_queue()
+
+
+@when('benchmark.joined')
+def register_benchmarks(benchmark):
+    benchmark.register('producer-perf', 'consumer-perf')
+
+
+def get_tuning_config():
+    """Return the tuning overrides from our charm config."""
+    config = hookenv.config()
+    return {option: config.get(option) for option in TUNING_OPTIONS}
+
+
+def get_log_dirs():
+    """Return the log dirs on our attached storage, if any."""
+    kv = unitdata.kv()
+    log_dirs = kv.get('kafka.storage.log_dirs')
+    if log_dirs is None:
+        # Charms before JBOD support tracked a single log dir.
+        log_dir = kv.get('kafka.storage.log_dir')
+        log_dirs = [log_dir] if log_dir else []
+    return log_dirs
+
+
 @hook('logs-storage-attached')
 def storage_attach():
+    """
+    Use every attached logs storage instance as a kafka log dir. This hook
+    runs once per instance; kafka needs a restart to pick up new dirs, but
+    partitions already on the other disks stay where they are.
+    """
     storageids = hookenv.storage_list('logs')
     if not storageids:
         hookenv.status_set('blocked', 'cannot locate attached storage')
         return
-    storageid = storageids[0]
 
-    mount = hookenv.storage_get('location', storageid)
-    if not mount:
-        hookenv.status_set('blocked', 'cannot locate attached storage mount')
-        return
+    log_dirs = set(get_log_dirs())
+    for storageid in storageids:
+        mount = hookenv.storage_get('location', storageid)
+        if not mount:
+            hookenv.status_set('blocked',
+                               'cannot locate attached storage mount')
+            return
+        log_dirs.add(os.path.join(mount, "logs"))
 
-    log_dir = os.path.join(mount, "logs")
-    unitdata.kv().set('kafka.storage.log_dir', log_dir)
-    hookenv.log('Kafka logs storage attached at {}'.format(log_dir))
+    log_dirs = sorted(log_dirs)
+    unitdata.kv().set('kafka.storage.log_dirs', log_dirs)
+    unitdata.kv().unset('kafka.storage.log_dir')
+    hookenv.log('Kafka logs storage attached at {}'.format(log_dirs))
     # Stop Kafka; removing the kafka.started state will trigger a reconfigure if/when it's ready
     kafka = Kafka()
     kafka.close_ports()
@@ -127,10 +428,29 @@ def storage_attach():
 
 @hook('logs-storage-detaching')
 def storage_detaching():
+    """
+    Stop using the log dir on the storage instance that is going away.
+    Partitions that lived there are re-replicated from the other brokers
+    once kafka restarts; the log dirs on our other disks are untouched.
+    """
+    mount = hookenv.storage_get('location')
+    log_dirs = get_log_dirs()
+    if mount:
+        log_dirs = [d for d in log_dirs
+                    if d != os.path.join(mount, "logs")]
+    else:
+        hookenv.log('Cannot locate detaching storage mount; '
+                    'dropping all attached log dirs', hookenv.WARNING)
+        log_dirs = []
+    unitdata.kv().set('kafka.storage.log_dirs', log_dirs)
     unitdata.kv().unset('kafka.storage.log_dir')
+
     kafka = Kafka()
     kafka.close_ports()
     kafka.stop()
     remove_state('kafka.started')
-    hookenv.status_set('waiting', 'reconfiguring to use temporary storage')
-    remove_state('kafka.storage.logs.attached')
+    if log_dirs:
+        hookenv.status_set('waiting', 'reconfiguring without detached storage')
+    else:
+        hookenv.status_set('waiting', 'reconfiguring to use temporary storage')
+        remove_state('kafka.storage.logs.attached')
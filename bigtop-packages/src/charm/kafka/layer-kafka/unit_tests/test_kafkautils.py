@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+from collections import Counter
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'actions'))
+
+# kafkautils only needs the charm libraries at action time.
+with mock.patch.dict(sys.modules, {
+        'charmhelpers': mock.MagicMock(),
+        'charmhelpers.core': mock.MagicMock(),
+        'charms': mock.MagicMock(),
+        'charms.layer': mock.MagicMock(),
+        'charms.layer.apache_bigtop_base': mock.MagicMock()}):
+    import kafkautils
+
+
+def apply_plan(assignments, plan):
+    result = dict((topic, dict(partitions))
+                  for topic, partitions in assignments.items())
+    for move in plan['partitions']:
+        result[move['topic']][move['partition']] = move['replicas']
+    return result
+
+
+def broker_load(assignments):
+    return Counter(replica for partitions in assignments.values()
+                   for replicas in partitions.values()
+                   for replica in replicas)
+
+
+class TestPlanReassignment(unittest.TestCase):
+    def test_balanced(self):
+        """Reordered replicas are left to leader election."""
+        assignments = {'test': {0: [0, 1], 1: [2, 0], 2: [1, 2]},
+                       'other': {0: [1, 0], 1: [0, 2], 2: [2, 1]}}
+        plan = kafkautils.plan_reassignment(assignments, [0, 1, 2])
+        self.assertEqual(plan, {'version': 1, 'partitions': []})
+
+    def test_new_broker(self):
+        """Only the new broker's share of replicas moves."""
+        assignments = {'test': dict((p, [p % 3, (p + 1) % 3])
+                                    for p in range(6))}
+        plan = kafkautils.plan_reassignment(assignments, [0, 1, 2, 3])
+        result = apply_plan(assignments, plan)
+
+        self.assertEqual(len(plan['partitions']), 3)
+        self.assertEqual(sorted(broker_load(result).values()), [3, 3, 3, 3])
+        for partition, replicas in assignments['test'].items():
+            target = result['test'][partition]
+            self.assertEqual(len(target), len(replicas))
+            self.assertEqual(len(set(target)), len(target))
+            # Each moved partition swaps a single replica.
+            self.assertGreaterEqual(len(set(target) & set(replicas)),
+                                    len(replicas) - 1)
+
+    def test_removed_broker(self):
+        """Replicas on a broker that is gone move to the others."""
+        assignments = {'test': {0: [0, 1], 1: [1, 2], 2: [2, 3], 3: [3, 0]}}
+        plan = kafkautils.plan_reassignment(assignments, [0, 1, 2])
+        result = apply_plan(assignments, plan)
+
+        self.assertEqual([m['partition'] for m in plan['partitions']], [2, 3])
+        self.assertNotIn(3, broker_load(result))
+        self.assertEqual(result['test'][2][0], 2)
+        self.assertEqual(result['test'][3][0], 0)
+
+    def test_too_few_brokers(self):
+        """The replication factor is never lowered to fit the brokers."""
+        assignments = {'test': {0: [0, 1, 2], 1: [1, 2, 0]}}
+        with self.assertRaises(ValueError):
+            kafkautils.plan_reassignment(assignments, [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
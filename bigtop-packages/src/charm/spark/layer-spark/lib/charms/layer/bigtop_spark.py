@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import stat
 import time
 from jujubigdata import utils
 from path import Path
@@ -24,6 +25,31 @@ from charmhelpers.fetch.archiveurl import ArchiveUrlFetchHandler
 from charmhelpers.payload import archive
 
 
+# Where a colocated DataNode serves short-circuit reads (Bigtop's default).
+DN_SOCKET = '/var/lib/hadoop-hdfs/dn_socket'
+SPARK_DEFAULTS = '/etc/spark/conf/spark-defaults.conf'
+
+
+def datanode_colocated():
+    """Return True if an HDFS DataNode runs on this machine."""
+    return host.service_running('hadoop-hdfs-datanode')
+
+
+def short_circuit_active():
+    """
+    Return True if Spark is configured for short-circuit reads and the
+    DataNode is serving its domain socket.
+    """
+    try:
+        with open(SPARK_DEFAULTS) as f:
+            configured = any(
+                line.split() == ['spark.hadoop.dfs.client.read.shortcircuit',
+                                 'true'] for line in f)
+        return configured and stat.S_ISSOCK(os.stat(DN_SOCKET).st_mode)
+    except OSError:
+        return False
+
+
 class Spark(object):
     """
     This class manages Spark.
@@ -298,6 +324,11 @@ class Spark(object):
                 ':'.join(extra_libs) if extra_libs else None,
             'spark::common::driver_mem': driver_mem,
             'spark::common::executor_mem': executor_mem,
+            # Read HDFS blocks straight from local disk when a DataNode
+            # runs alongside us.
+            'spark::common::hdfs_domain_socket_path':
+                DN_SOCKET if ('namenode' in hosts and
+                              datanode_colocated()) else None,
         }
         if zk_units:
             zks = []
@@ -16,7 +16,7 @@ import time
 
 from charms.reactive import RelationBase, when, when_not, is_state, set_state, remove_state, when_any
 from charms.layer.apache_bigtop_base import Bigtop, get_fqdn, get_package_version
-from charms.layer.bigtop_spark import Spark
+from charms.layer.bigtop_spark import Spark, datanode_colocated, short_circuit_active
 from charmhelpers.core import hookenv, host, unitdata
 from charms import leadership
 from charms.reactive.helpers import data_changed
@@ -46,6 +46,9 @@ def report_status():
     if is_state('spark.cuda.configured'):
         mode = mode + " with CUDA"
 
+    if is_state('spark.started') and short_circuit_active():
+        mode = mode + ", short-circuit reads"
+
     if is_state('spark.started'):
         # inform the user if we have a different repo pkg available
         repo_ver = unitdata.kv().get('spark.version.repo', False)
@@ -183,6 +186,7 @@ def reinstall_spark(force=False):
         'hdfs_ready': is_state('hadoop.hdfs.ready'),
         'peers': peers,
         'sample_data': host.file_hash(sample_data) if sample_data else None,
+        'short_circuit': datanode_colocated(),
         'spark_master': spark_master_host,
         'yarn_ready': is_state('hadoop.yarn.ready'),
         'zookeepers': zks,
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Zookeeper load generator.
+
+Runs a number of concurrent client sessions, each issuing a weighted mix
+of create, get, set, delete and watch operations against an ensemble,
+and reports throughput and latency percentiles per operation type.
+
+Used by the zk-bench action, but can also be pointed at any Zookeeper
+server directly, e.g. a local single-node server:
+
+    ./zkbench.py --hosts 127.0.0.1:2181 --sessions 4 --requests 500
+"""
+
+import argparse
+import bisect
+import json
+import math
+import random
+import threading
+import time
+
+from kazoo.client import KazooClient
+from kazoo.exceptions import NodeExistsError, NoNodeError
+
+OPERATIONS = ('create', 'get', 'set', 'delete', 'watch')
+DEFAULT_MIX = 'create:20,get:50,set:20,delete:10,watch:0'
+ROOT = '/zk-bench'
+
+
+def parse_mix(mix):
+    """
+    Parse an operation mix such as 'get:70,set:30' into a dict of
+    weights. Operations that are not mentioned get a weight of 0.
+    """
+    weights = dict.fromkeys(OPERATIONS, 0)
+    for item in mix.split(','):
+        if not item.strip():
+            continue
+        op, _, weight = item.partition(':')
+        op = op.strip()
+        if op not in weights:
+            raise ValueError('Unknown operation: {}'.format(op))
+        weights[op] = int(weight or 1)
+    if not any(weights.values()):
+        raise ValueError('Operation mix is empty: {}'.format(mix))
+    return weights
+
+
+def weighted_choice(choices, cum_weights, rng=random):
+    """
+    Pick from choices given their cumulative weights (random.choices
+    is not available on Python 3.5).
+    """
+    return choices[bisect.bisect(cum_weights, rng.random() * cum_weights[-1])]
+
+
+def cumulative(weights):
+    total, cum_weights = 0, []
+    for weight in weights:
+        total += weight
+        cum_weights.append(total)
+    return cum_weights
+
+
+def percentile(latencies, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not latencies:
+        return 0
+    rank = int(math.ceil(round(pct * len(latencies) / 100.0, 6))) - 1
+    return latencies[min(max(rank, 0), len(latencies) - 1)]
+
+
+class Session(threading.Thread):
+    """
+    One client session. Keeps track of the znodes it has created, so
+    that get, set, delete and watch operations always have a target.
+    """
+    def __init__(self, hosts, base, requests, weights, value_size,
+                 timeout=10):
+        super(Session, self).__init__()
+        self.daemon = True
+        self.client = KazooClient(hosts=hosts, timeout=timeout)
+        self.base = base
+        self.requests = requests
+        self.ops = [op for op in OPERATIONS if weights[op]]
+        self.cum_weights = cumulative(weights[op] for op in self.ops)
+        self.value = b'x' * value_size
+        self.timeout = timeout
+        self.znodes = []
+        self.counter = 0
+        self.latencies = dict((op, []) for op in OPERATIONS)
+        self.errors = 0
+        self.failure = None
+
+    def _new_path(self):
+        self.counter += 1
+        return '{}/n{}'.format(self.base, self.counter)
+
+    def create(self):
+        path = self._new_path()
+        self.client.create(path, self.value)
+        self.znodes.append(path)
+
+    def get(self):
+        self.client.get(random.choice(self.znodes))
+
+    def set(self):
+        self.client.set(random.choice(self.znodes), self.value)
+
+    def delete(self):
+        path = self.znodes.pop(random.randrange(len(self.znodes)))
+        self.client.delete(path)
+
+    def watch(self):
+        """
+        Set a data watch, change the znode, and wait for the
+        notification; the latency is the full round trip.
+        """
+        fired = threading.Event()
+        path = random.choice(self.znodes)
+        self.client.get(path, watch=lambda event: fired.set())
+        self.client.set(path, self.value)
+        if not fired.wait(self.timeout):
+            raise RuntimeError('Watch on {} did not fire'.format(path))
+
+    def run(self):
+        try:
+            self.client.start(timeout=self.timeout)
+        except Exception as e:
+            self.failure = e
+            return
+        try:
+            self.client.ensure_path(self.base)
+            for _ in range(self.requests):
+                op = weighted_choice(self.ops, self.cum_weights)
+                if op != 'create' and not self.znodes:
+                    # Nothing to operate on yet.
+                    op = 'create'
+                start = time.time()
+                try:
+                    getattr(self, op)()
+                except (NodeExistsError, NoNodeError, RuntimeError):
+                    self.errors += 1
+                    continue
+                self.latencies[op].append(time.time() - start)
+        except Exception as e:
+            self.failure = e
+        finally:
+            self.client.stop()
+            self.client.close()
+
+
+def run(hosts, sessions=10, requests=1000, mix=DEFAULT_MIX, value_size=100):
+    """
+    Run the benchmark and return a dict of results. Latencies are in
+    milliseconds.
+    """
+    weights = parse_mix(mix)
+    run_root = '{}/{}'.format(ROOT, int(time.time() * 1000))
+    workers = [Session(hosts, '{}/s{}'.format(run_root, i), requests,
+                       weights, value_size)
+               for i in range(sessions)]
+
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    duration = time.time() - start
+
+    failures = [w.failure for w in workers if w.failure]
+    if len(failures) == len(workers):
+        raise RuntimeError('All sessions failed: {}'.format(failures[0]))
+
+    results = {
+        'sessions': sessions,
+        'duration': round(duration, 3),
+        'errors': sum(w.errors for w in workers),
+        'failed_sessions': len(failures),
+        'operations': {},
+    }
+    total = 0
+    for op in OPERATIONS:
+        latencies = sorted(l for w in workers for l in w.latencies[op])
+        if not latencies:
+            continue
+        total += len(latencies)
+        results['operations'][op] = {
+            'count': len(latencies),
+            'ops_per_sec': round(len(latencies) / duration, 2),
+            'p50': round(percentile(latencies, 50) * 1000, 3),
+            'p99': round(percentile(latencies, 99) * 1000, 3),
+            'p999': round(percentile(latencies, 99.9) * 1000, 3),
+        }
+    results['ops_per_sec'] = round(total / duration, 2)
+
+    cleanup(hosts, run_root)
+    return results
+
+
+def cleanup(hosts, path):
+    client = KazooClient(hosts=hosts)
+    client.start()
+    try:
+        client.delete(path, recursive=True)
+    except NoNodeError:
+        pass
+    finally:
+        client.stop()
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Zookeeper load generator')
+    parser.add_argument('--hosts', default='127.0.0.1:2181',
+                        help='comma separated list of host:port')
+    parser.add_argument('--sessions', type=int, default=10,
+                        help='number of concurrent client sessions')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='number of operations per session')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='weighted operation mix, e.g. get:70,set:30')
+    parser.add_argument('--value-size', type=int, default=100,
+                        help='size (in bytes) of znode data')
+    args = parser.parse_args()
+    print(json.dumps(run(args.hosts, args.sessions, args.requests, args.mix,
+                         args.value_size), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
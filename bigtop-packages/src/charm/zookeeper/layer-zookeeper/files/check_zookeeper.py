@@ -31,6 +31,7 @@ import sys
 import socket
 import logging
 import re
+import struct
 import subprocess
 
 from StringIO import StringIO
@@ -134,6 +135,12 @@ class CactiHandler(object):
 
 class GangliaHandler(object):
 
+    # gmond (>= 3.1) XDR packet ids
+    GMETADATA_FULL = 128
+    GMETRIC_STRING = 133
+
+    SLOPE_BOTH = 3
+
     @classmethod
     def register_options(cls, parser):
         group = OptionGroup(parser, 'Ganglia specific options')
@@ -142,6 +149,15 @@ class GangliaHandler(object):
             default='/usr/bin/gmetric', help='ganglia gmetric binary '\
             'location: /usr/bin/gmetric')
 
+        group.add_option('--gmond', dest='gmond',
+            default='localhost:8649', help='gmond udp receive channel '\
+            'HOST:PORT, default: localhost:8649')
+
+        group.add_option('--ganglia-transport', dest='ganglia_transport',
+            default='udp', choices=['udp', 'gmetric'],
+            help='send metrics as XDR packets straight to gmond (udp) '\
+            'or through the gmetric binary (gmetric), default: udp')
+
         parser.add_option_group(group)
 
     def call(self, *args, **kwargs):
@@ -152,12 +168,82 @@ class GangliaHandler(object):
             print >>sys.stderr, 'Only allowed to monitor a single node.'
             return 1
 
+        metrics = []
         for host, stats in cluster_stats.items():
             for k, v in stats.items():
-                try:
-                    self.call([opts.gmetric, '-n', k, '-v', str(int(v)), '-t', 'uint32'])
-                except (TypeError, ValueError):
-                    pass
+                metrics.append((k, v, self._metric_type(v)))
+
+        if opts.ganglia_transport == 'gmetric':
+            for name, value, metric_type in metrics:
+                self.call([opts.gmetric, '-n', name, '-v', str(value),
+                           '-t', metric_type])
+            return 0
+
+        try:
+            gmond_host, gmond_port = opts.gmond.split(':')
+            self.send(metrics, (gmond_host, int(gmond_port)))
+        except (ValueError, socket.error), e:
+            print >>sys.stderr, 'Unable to send metrics to gmond: %s' % e
+            return 1
+        return 0
+
+    def send(self, metrics, address):
+        """ Send all metrics to gmond in one pass over a single socket """
+        hostname = socket.gethostname()
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for name, value, metric_type in metrics:
+                meta, data = self._packets(hostname, name, value, metric_type)
+                s.sendto(meta, address)
+                s.sendto(data, address)
+        finally:
+            s.close()
+
+    def _metric_type(self, value):
+        if isinstance(value, (int, long)):
+            if 0 <= value < 2 ** 32:
+                return 'uint32'
+            if -2 ** 31 <= value < 2 ** 31:
+                return 'int32'
+            return 'double'
+        if isinstance(value, float):
+            return 'double'
+        return 'string'
+
+    def _packets(self, hostname, name, value, metric_type, tmax=60):
+        """ Build the gmond metadata and value packets for one metric """
+        meta = ''.join([
+            _xdr_uint(self.GMETADATA_FULL),
+            _xdr_string(hostname),
+            _xdr_string(name),
+            _xdr_uint(0),  # spoof
+            _xdr_string(metric_type),
+            _xdr_string(name),
+            _xdr_string(''),  # units
+            _xdr_uint(self.SLOPE_BOTH),
+            _xdr_uint(tmax),
+            _xdr_uint(0),  # dmax
+            _xdr_uint(1),  # extra data: the metric group
+            _xdr_string('GROUP'),
+            _xdr_string('zookeeper'),
+        ])
+        data = ''.join([
+            _xdr_uint(self.GMETRIC_STRING),
+            _xdr_string(hostname),
+            _xdr_string(name),
+            _xdr_uint(0),  # spoof
+            _xdr_string('%s'),
+            _xdr_string(str(value)),
+        ])
+        return meta, data
+
+def _xdr_uint(value):
+    return struct.pack('>I', value)
+
+def _xdr_string(value):
+    """ XDR string: length, then the bytes padded to a 4 byte boundary """
+    value = str(value)
+    return struct.pack('>I', len(value)) + value + '\0' * (-len(value) % 4)
 
 class ZooKeeperServer(object):
 
@@ -261,10 +347,12 @@ class ZooKeeperServer(object):
         if not key:
             raise ValueError('The key is mandatory and should not be empty')
 
-        try:
-            value = int(value)
-        except (TypeError, ValueError):
-            pass
+        for cast in (int, float):
+            try:
+                value = cast(value)
+                break
+            except (TypeError, ValueError):
+                pass
 
         return key, value
 
@@ -13,9 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import subprocess
+import os
+import shutil
+import socket
+import time
 
-from charmhelpers.core import host
+from charmhelpers.core import host, unitdata
 from charmhelpers.core.hookenv import (open_port, close_port, log,
                                        unit_private_ip, local_unit, config)
 from charms import layer
@@ -24,14 +27,72 @@ from charms.reactive.relations import RelationBase
 from jujubigdata.utils import DistConfig
 
 
-def format_node(unit, node_ip):
+# Seconds for which we trust a cached Zookeeper role.
+ROLE_CACHE_TTL = 10
+
+# Where puppet has Zookeeper keep its snapshots (and, by default, its
+# transaction logs).
+DATA_DIR = '/var/lib/zookeeper'
+
+
+def format_node(unit, node_ip, observer=False):
     '''
     Given a juju unit name and an ip address, return a tuple
     containing an id and formatted ip string suitable for passing to
     puppet, which will write it out to zoo.cfg.
 
+    Observers are marked as such, so that they are left out of the
+    quorum that every write must wait for.
+
+    '''
+    node = "{ip}:2888:3888".format(ip=node_ip)
+    if observer:
+        node += ":observer"
+    return (unit.split("/")[1], node)
+
+
+def four_letter_word(cmd, host='127.0.0.1', port=2181, timeout=2):
     '''
-    return (unit.split("/")[1], "{ip}:2888:3888".format(ip=node_ip))
+    Send one of Zookeeper's "four letter word" commands (ruok, srvr,
+    mntr, etc.) to a server, and return the decoded response.
+
+    Raises socket.error if the server cannot be reached.
+
+    '''
+    sock = socket.create_connection((host, int(port)), timeout=timeout)
+    try:
+        sock.sendall(cmd.encode('utf-8'))
+        chunks = []
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    return b''.join(chunks).decode('utf-8')
+
+
+def parse_srvr(output):
+    '''
+    Parse the output of the "srvr" command into a dict. We care about
+    the mode (leader, follower, standalone) and the zxid, which we
+    convert to an int so that it can be compared.
+
+    '''
+    status = {}
+    for line in output.splitlines():
+        key, sep, value = line.partition(':')
+        if not sep:
+            continue
+        key, value = key.strip().lower(), value.strip()
+        if key == 'zxid':
+            status['zxid'] = int(value, 16)
+        elif key == 'mode':
+            status['mode'] = value
+        elif key == 'zookeeper version':
+            status['version'] = value
+    return status
 
 
 class Zookeeper(object):
@@ -52,27 +113,133 @@ class Zookeeper(object):
         Attempt to determine whether this node is the Zookeeper leader.
 
         Note that Zookeeper tracks leadership independently of juju,
-        and that this command can fail, depending on the state that
+        and that this check can fail, depending on the state that
         the Zookeeper node is in when we attempt to run it.
 
         '''
-        try:
-            status = subprocess.check_output(
-                ["/usr/lib/zookeeper/bin/zkServer.sh", "status"])
-            return "leader" in status.decode('utf-8')
-        except Exception:
+        role = self.zk_role()
+        if role is None:
             log(
                 "Unable to determine whether this node is the Zookeeper leader.",
                 level="WARN"
             )
+        return role == 'leader'
+
+    def zk_role(self, ttl=ROLE_CACHE_TTL):
+        '''
+        Return the role of the local server (leader, follower, observer,
+        or standalone), or None if the server is not serving requests.
+
+        The role is asked for over the client port with the srvr (or,
+        failing that, mntr) command, and cached in unitdata for ttl
+        seconds, so that callers like sort_peers may ask repeatedly.
+
+        '''
+        kv = unitdata.kv()
+        cached = kv.get('zookeeper.role')
+        if cached and time.time() - cached['timestamp'] < ttl:
+            return cached['role']
+
+        role = self.server_status().get('mode')
+        if role is None:
+            try:
+                for line in self.four_letter_word('mntr').splitlines():
+                    key, _, value = line.partition('\t')
+                    if key == 'zk_server_state':
+                        role = value.strip()
+            except (socket.error, UnicodeDecodeError):
+                pass
+
+        if role is None:
+            # Don't cache failures; the server may just be starting up.
+            kv.unset('zookeeper.role')
+        else:
+            kv.set('zookeeper.role', {'role': role,
+                                      'timestamp': time.time()})
+        return role
+
+    def _invalidate_role(self):
+        unitdata.kv().unset('zookeeper.role')
+
+    def client_address(self):
+        '''
+        Return the (host, port) tuple that the local Zookeeper server
+        accepts client connections on.
+
+        '''
+        network_interface = config().get('network_interface')
+        if network_interface:
+            ip = Bigtop().get_ip_for_interface(network_interface)
+            if ip and ip != '0.0.0.0':
+                return (ip, self.dist_config.port('zookeeper'))
+        return ('127.0.0.1', self.dist_config.port('zookeeper'))
+
+    def four_letter_word(self, cmd, timeout=2):
+        '''
+        Send a four letter word command to the local Zookeeper server.
+
+        '''
+        host, port = self.client_address()
+        return four_letter_word(cmd, host, port, timeout=timeout)
+
+    def is_healthy(self):
+        '''
+        Return True if the local server answers "imok" to "ruok".
+
+        '''
+        try:
+            return self.four_letter_word('ruok').strip() == 'imok'
+        except (socket.error, UnicodeDecodeError):
             return False
 
-    def read_peers(self):
+    def server_status(self):
         '''
-        Fetch the list of peers available.
+        Return the parsed "srvr" output for the local server, or an
+        empty dict if the server is not serving requests.
 
-        The first item in this list should always be the node that
-        this code is executing on.
+        Note that a server which is up but has not (re)joined a quorum
+        answers "This ZooKeeper instance is not currently serving
+        requests", which parses to an empty dict as well.
+
+        '''
+        try:
+            return parse_srvr(self.four_letter_word('srvr'))
+        except (socket.error, UnicodeDecodeError, ValueError):
+            return {}
+
+    def has_rejoined(self, min_zxid=0):
+        '''
+        Return True if the local server is healthy, is part of a quorum
+        (or running standalone), and has synced at least up to
+        min_zxid.
+
+        '''
+        if not self.is_healthy():
+            return False
+        status = self.server_status()
+        if status.get('mode') not in ('leader', 'follower', 'observer',
+                                      'standalone'):
+            return False
+        return status.get('zxid', -1) >= min_zxid
+
+    def wait_for_rejoin(self, min_zxid=0, timeout=120, interval=2):
+        '''
+        Poll the local server until it has rejoined the quorum. Returns
+        True if it did so within timeout seconds.
+
+        '''
+        deadline = time.time() + timeout
+        while True:
+            if self.has_rejoined(min_zxid):
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(interval)
+
+    def _nodes(self):
+        '''
+        Return (unit, ip) tuples for this node and its peers, starting
+        with this node.
 
         '''
         # A Zookeeper node likes to be first on the list.
@@ -81,9 +248,45 @@ class Zookeeper(object):
         zkpeer = RelationBase.from_state('zkpeer.joined')
         if zkpeer:
             nodes.extend(sorted(zkpeer.get_nodes()))
-        nodes = [format_node(*node) for node in nodes]
         return nodes
 
+    def observers(self, units):
+        '''
+        Given the names of all units in the ensemble, return the set of
+        those that should join as observers rather than voters.
+
+        The max_voters units with the lowest unit numbers vote; any
+        others are observers, which serve reads (and forward writes)
+        without adding to the quorum that each write must wait for.
+
+        '''
+        max_voters = config().get('max_voters') or 0
+        if max_voters <= 0:
+            return set()
+        ordered = sorted(units, key=lambda unit: int(unit.split('/')[1]))
+        return set(ordered[max_voters:])
+
+    def is_observer(self):
+        '''
+        Return True if this node should join the ensemble as an observer.
+
+        '''
+        units = [unit for unit, _ in self._nodes()]
+        return local_unit() in self.observers(units)
+
+    def read_peers(self):
+        '''
+        Fetch the list of peers available.
+
+        The first item in this list should always be the node that
+        this code is executing on.
+
+        '''
+        nodes = self._nodes()
+        observers = self.observers([unit for unit, _ in nodes])
+        return [format_node(unit, ip, unit in observers)
+                for unit, ip in nodes]
+
     def sort_peers(self, zkpeer):
         '''
         Return peers, sorted in an order suitable for performing a rolling
@@ -92,7 +295,7 @@ class Zookeeper(object):
         '''
         peers = self.read_peers()
         leader = zkpeer.find_zk_leader()
-        peers.sort(key=lambda x: x[1] == leader)
+        peers.sort(key=lambda x: x[1].split(':')[0] == leader)
 
         return peers
 
@@ -128,9 +331,79 @@ class Zookeeper(object):
         if autopurge_snap_retain_count:
             key = "hadoop_zookeeper::server::autopurge_snap_retain_count"
             override[key] = autopurge_snap_retain_count
+        if self.is_observer():
+            override["hadoop_zookeeper::server::peer_type"] = "observer"
+        if self.txnlog_dir != DATA_DIR:
+            key = "hadoop_zookeeper::server::datalogdir"
+            override[key] = self.txnlog_dir
+        txnlog_prealloc_size = conf.get('txnlog_prealloc_size')
+        if txnlog_prealloc_size:
+            key = "hadoop_zookeeper::server::preallocsize"
+            override[key] = txnlog_prealloc_size
 
         return override
 
+    @property
+    def txnlog_dir(self):
+        '''
+        The directory that the transaction log should be written to:
+        attached txnlog storage, if we have it, or the data dir.
+
+        '''
+        return unitdata.kv().get('zookeeper.storage.txnlog_dir') or DATA_DIR
+
+    def purge_manager(self):
+        '''
+        Return a PurgeManager for our snapshot and transaction log dirs.
+
+        '''
+        retain = config().get('autopurge_snap_retain_count') or 3
+        return PurgeManager(DATA_DIR, self.txnlog_dir, retain)
+
+    def relocate_txnlog(self):
+        '''
+        If the transaction log directory has changed (txnlog storage was
+        attached or is detaching), stop Zookeeper and move the existing
+        transaction logs over, so that the server picks up where it
+        left off once puppet restarts it.
+
+        '''
+        kv = unitdata.kv()
+        old_dir = kv.get('zookeeper.txnlog_dir.active') or DATA_DIR
+        new_dir = self.txnlog_dir
+        if old_dir == new_dir:
+            return
+
+        if host.service_running('zookeeper-server'):
+            self.stop()
+
+        src = os.path.join(old_dir, 'version-2')
+        dst = os.path.join(new_dir, 'version-2')
+        host.mkdir(dst, perms=0o755)
+        if os.path.isdir(src):
+            for name in os.listdir(src):
+                if name.startswith('log.'):
+                    log("Moving transaction log {} to {}".format(name, dst))
+                    shutil.move(os.path.join(src, name),
+                                os.path.join(dst, name))
+        self._chown_txnlog_dir()
+
+        kv.set('zookeeper.txnlog_dir.active', new_dir)
+        kv.flush(True)
+
+    def _chown_txnlog_dir(self):
+        '''
+        Hand the transaction log dir to the zookeeper user. Returns False
+        if that user does not exist yet (i.e., puppet has not installed
+        the package).
+
+        '''
+        if not host.user_exists('zookeeper'):
+            return False
+        host.chownr(self.txnlog_dir, 'zookeeper', 'zookeeper',
+                    chowntopdir=True)
+        return True
+
     def install(self, nodes=None):
         '''
         Write out the config, then run puppet.
@@ -138,10 +411,18 @@ class Zookeeper(object):
         After this runs, we should have a configured and running service.
 
         '''
+        needs_chown = not host.user_exists('zookeeper')
+        self.relocate_txnlog()
         bigtop = Bigtop()
         log("Rendering site yaml ''with overrides: {}".format(self._override))
         bigtop.render_site_yaml(self._hosts, self._roles, self._override)
         bigtop.trigger_puppet()
+        if needs_chown and self.txnlog_dir != DATA_DIR:
+            # puppet has just created the zookeeper user, and started the
+            # server before it could write to our txnlog storage.
+            self._chown_txnlog_dir()
+            host.service_restart('zookeeper-server')
+        self._invalidate_role()
         if self.is_zk_leader():
             zkpeer = RelationBase.from_state('zkpeer.joined')
             zkpeer.set_zk_leader()
@@ -153,6 +434,7 @@ class Zookeeper(object):
 
         '''
         host.service_start('zookeeper-server')
+        self._invalidate_role()
 
     def stop(self):
         '''
@@ -160,6 +442,7 @@ class Zookeeper(object):
 
         '''
         host.service_stop('zookeeper-server')
+        self._invalidate_role()
 
     def open_ports(self):
         '''
@@ -180,18 +463,161 @@ class Zookeeper(object):
     def quorum_check(self):
         '''
         Returns a string reporting the node count. Append a message
-        informing the user if the node count is too low for good quorum,
-        or is even (meaning that one of the nodes is redundant for
-        quorum).
+        informing the user if the number of voting nodes is too low for
+        good quorum, or is even (meaning that one of the nodes is
+        redundant for quorum).
 
         '''
-        node_count = len(self.read_peers())
+        nodes = self.read_peers()
+        node_count = len(nodes)
+        observer_count = len(
+            [node for node in nodes if node[1].endswith(':observer')])
+        voter_count = node_count - observer_count
         if node_count == 1:
             count_str = "{} unit".format(node_count)
         else:
             count_str = "{} units".format(node_count)
-        if node_count < 3:
-            return " ({}; less than 3 is suboptimal)".format(count_str)
-        if node_count % 2 == 0:
-            return " ({}; an even number is suboptimal)".format(count_str)
+        too_few, even = "less than 3", "an even number"
+        if observer_count:
+            count_str += ", {} observing".format(observer_count)
+            too_few, even = "less than 3 voters", "an even number of voters"
+        if voter_count < 3:
+            return " ({}; {} is suboptimal)".format(count_str, too_few)
+        if voter_count % 2 == 0:
+            return " ({}; {} is suboptimal)".format(count_str, even)
         return "({})".format(count_str)
+
+
+class PurgeManager(object):
+    '''
+    Keep an eye on the disks holding Zookeeper snapshots and transaction
+    logs, and purge old ones when they fill up faster than the
+    autopurge task (which runs every autopurge_purge_interval hours)
+    can keep up with.
+
+    Purging follows the same rules as zkCleanup.sh: keep the most recent
+    `retain` snapshots, and any transaction log that may hold
+    transactions newer than the oldest of them.
+
+    '''
+    # How many usage samples we keep to estimate snapshot growth.
+    HISTORY = 12
+
+    def __init__(self, data_dir=DATA_DIR, txnlog_dir=None, retain=3):
+        self.data_dir = data_dir
+        self.txnlog_dir = txnlog_dir or data_dir
+        self.retain = max(int(retain), 3)
+
+    @staticmethod
+    def _files(directory, prefix):
+        '''
+        Return (zxid, path, size) for each snapshot or log file in
+        directory, oldest first.
+
+        '''
+        version_dir = os.path.join(directory, 'version-2')
+        if not os.path.isdir(version_dir):
+            return []
+        files = []
+        for name in os.listdir(version_dir):
+            if not name.startswith(prefix + '.'):
+                continue
+            try:
+                zxid = int(name.split('.', 1)[1], 16)
+            except ValueError:
+                continue
+            path = os.path.join(version_dir, name)
+            files.append((zxid, path, os.path.getsize(path)))
+        return sorted(files)
+
+    def snapshots(self):
+        return self._files(self.data_dir, 'snapshot')
+
+    def txnlogs(self):
+        return self._files(self.txnlog_dir, 'log')
+
+    def disk_usage(self):
+        '''
+        Return the used percentage of the filesystem(s) holding the data
+        and transaction log dirs, keyed by dir.
+
+        '''
+        usage = {}
+        for directory in set([self.data_dir, self.txnlog_dir]):
+            if not os.path.isdir(directory):
+                continue
+            st = os.statvfs(directory)
+            total = st.f_blocks * st.f_frsize
+            free = st.f_bavail * st.f_frsize
+            usage[directory] = {
+                'total': total,
+                'used': total - free,
+                'percent': 100.0 * (total - free) / total if total else 0,
+            }
+        return usage
+
+    def growth_rate(self):
+        '''
+        Sample the size of our snapshots and logs, and return how fast
+        (in bytes per hour) they have been growing over recent samples.
+
+        '''
+        kv = unitdata.kv()
+        history = kv.get('zookeeper.purge.history', [])
+        size = sum(f[2] for f in self.snapshots() + self.txnlogs())
+        history = (history + [[time.time(), size]])[-self.HISTORY:]
+        kv.set('zookeeper.purge.history', history)
+
+        (first_ts, first_size), (last_ts, last_size) = history[0], history[-1]
+        if last_ts <= first_ts:
+            return 0
+        # Purges shrink the total; only count growth.
+        return max(0, (last_size - first_size) / ((last_ts - first_ts) / 3600))
+
+    def needs_purge(self, threshold, interval):
+        '''
+        Return True if any of our disks is above threshold percent used,
+        or will be before the next autopurge (interval hours from now)
+        at the current rate of growth.
+
+        '''
+        rate = self.growth_rate()
+        for usage in self.disk_usage().values():
+            if not usage['total']:
+                continue
+            projected = usage['used'] + rate * interval
+            if 100.0 * projected / usage['total'] >= threshold:
+                return True
+        return False
+
+    def purge(self):
+        '''
+        Delete all but the most recent snapshots, and the transaction logs
+        that they make redundant. Returns the number of bytes reclaimed.
+
+        '''
+        snapshots = self.snapshots()
+        if len(snapshots) <= self.retain:
+            return 0
+
+        # Everything up to the oldest snapshot we keep can go...
+        min_zxid = snapshots[-self.retain][0]
+        doomed = snapshots[:-self.retain]
+
+        # ...except the log that was being written when that snapshot was
+        # taken: it may also hold later transactions.
+        txnlogs = self.txnlogs()
+        older_logs = [f for f in txnlogs if f[0] <= min_zxid]
+        if older_logs:
+            doomed.extend(older_logs[:-1])
+
+        reclaimed = 0
+        for zxid, path, size in doomed:
+            log("Purging {}".format(path))
+            try:
+                os.remove(path)
+            except OSError as e:
+                log("Unable to purge {}: {}".format(path, e), level="WARN")
+            else:
+                reclaimed += size
+        return reclaimed
@@ -15,11 +15,12 @@
 
 import json
 import time
-from charmhelpers.core import hookenv
+from charmhelpers.core import hookenv, unitdata
 from charms.layer.apache_bigtop_base import get_package_version
 from charms.layer.bigtop_zookeeper import Zookeeper
 from charms.leadership import leader_set, leader_get
 from charms.reactive import (
+    RelationBase,
     hook,
     is_state,
     remove_state,
@@ -146,6 +147,10 @@ def install_zookeeper():
     data_changed(
         'zk.autopurge_snap_retain_count',
         hookenv.config().get('autopurge_snap_retain_count'))
+    data_changed(
+        'zk.txnlog_prealloc_size',
+        hookenv.config().get('txnlog_prealloc_size'))
+    data_changed('zk.txnlog_dir', zookeeper.txnlog_dir)
     zookeeper.install()
     zookeeper.open_ports()
     set_state('zookeeper.installed')
@@ -193,6 +198,94 @@ def update_autopurge_snap_retain_count():
         _restart_zookeeper('updating number of retained snapshots')
 
 
+@when('zookeeper.started')
+def update_txnlog_prealloc_size():
+    prealloc_size = hookenv.config().get('txnlog_prealloc_size')
+    if data_changed('zk.txnlog_prealloc_size', prealloc_size):
+        _restart_zookeeper('updating transaction log preallocation size')
+
+
+@hook('update-status')
+def purge_under_disk_pressure():
+    '''
+    The autopurge task only runs every autopurge_purge_interval hours.
+    If our snapshots and logs are filling the disk faster than that,
+    purge them now rather than waiting for the disk to fill up.
+
+    '''
+    if not is_state('zookeeper.started'):
+        return
+    threshold = hookenv.config().get('purge_disk_threshold')
+    if not threshold:
+        return
+
+    interval = int(hookenv.config().get('autopurge_purge_interval') or 24)
+    purger = Zookeeper().purge_manager()
+    if purger.needs_purge(threshold, interval):
+        reclaimed = purger.purge()
+        hookenv.log('Disk usage above {}%; purged {} bytes of snapshots and '
+                    'transaction logs'.format(threshold, reclaimed))
+        unitdata.kv().set('zookeeper.purge.last', {
+            'timestamp': time.time(),
+            'reclaimed': reclaimed,
+        })
+
+
+@hook('txnlog-storage-attached')
+def storage_attach():
+    storageids = hookenv.storage_list('txnlog')
+    if not storageids:
+        hookenv.status_set('blocked', 'cannot locate attached storage')
+        return
+    storageid = storageids[0]
+
+    mount = hookenv.storage_get('location', storageid)
+    if not mount:
+        hookenv.status_set('blocked', 'cannot locate attached storage mount')
+        return
+
+    txnlog_dir = os.path.join(mount, "txnlog")
+    unitdata.kv().set('zookeeper.storage.txnlog_dir', txnlog_dir)
+    hookenv.log('Zookeeper txnlog storage attached at {}'.format(txnlog_dir))
+    set_state('zookeeper.storage.txnlog.attached')
+
+
+@hook('txnlog-storage-detaching')
+def storage_detaching():
+    unitdata.kv().unset('zookeeper.storage.txnlog_dir')
+    remove_state('zookeeper.storage.txnlog.attached')
+    if is_state('zookeeper.installed'):
+        # The storage goes away when this hook exits, so we cannot wait
+        # for our turn in a rolling restart; move the logs back now.
+        _restart_zookeeper('moving transaction logs off detaching storage')
+        data_changed('zk.txnlog_dir', Zookeeper().txnlog_dir)
+
+
+@when('zookeeper.started')
+def update_txnlog_dir():
+    '''
+    Our transaction log storage has changed. Moving the logs means
+    restarting Zookeeper, so ask the leader to fit us into a rolling
+    restart, unless we are on our own.
+
+    '''
+    txnlog_dir = Zookeeper().txnlog_dir
+    if not data_changed('zk.txnlog_dir', txnlog_dir):
+        return
+
+    zkpeer = RelationBase.from_state('zkpeer.joined')
+    if zkpeer:
+        hookenv.log('Requesting rolling restart to move transaction logs '
+                    'to {}'.format(txnlog_dir))
+        hookenv.status_set('waiting', 'waiting to move transaction logs')
+        request = json.dumps(time.time())
+        unitdata.kv().set('zookeeper.restart_request', request)
+        for conv in zkpeer.conversations():
+            conv.set_remote('restart_request', request)
+    else:
+        _restart_zookeeper('moving transaction logs')
+
+
 @when('zookeeper.started', 'zookeeper.joined')
 def serve_client(client):
     config = Zookeeper().dist_config
@@ -201,6 +294,11 @@ def serve_client(client):
     client.send_port(port, rest_port)
 
 
+@when('benchmark.joined')
+def register_benchmarks(benchmark):
+    benchmark.register('zk-bench')
+
+
 #
 # Rolling restart -- helpers and handlers
 #
@@ -236,10 +334,21 @@ def serve_client(client):
 #    leadership.changed.restart_queue event. If the node isn't the
 #    Juju leader, it will restart itself, then run `inform_restart`.
 #
+#    Before it does either, the node waits (`check_rejoin`) until the
+#    restarted server answers `ruok` with `imok`, and `srvr` reports
+#    that it is a leader or follower with a zxid at least as recent as
+#    the one it had before the restart. Only then is the next node
+#    released. If the server has not rejoined within the hook, the
+#    `zookeeper.rejoin.pending` state makes us check again on the next
+#    hook (e.g. update-status).
+#
 # 3. `inform_restart` will create a relation data changed event, which
 #    triggers `update_restart_queue` to run on the leader. This method
 #    will update the restart_queue, clearing any nodes that have
 #    restarted for the current nonce, and looping us back to step 2.
+#    Each node also publishes how long its restart and rejoin took;
+#    the leader collects these, and once the queue is empty records
+#    the total quorum impact in the "restart_report" leadership data.
 #
 # 4. Once all the nodes have restarted, we should be in the following state:
 #
@@ -291,14 +400,42 @@ def check_cluster(zkpeer):
 
     '''
     zk = Zookeeper()
+    requested = _restart_requests(zkpeer)
     if data_changed('zkpeer.nodes', zk.read_peers()):
         peers = _ip_list(zk.sort_peers(zkpeer))
-        nonce = time.time()
         hookenv.log('Quorum changed. Restart queue: {}'.format(peers))
-        leader_set(
-            restart_queue=json.dumps(peers),
-            restart_nonce=json.dumps(nonce)
-        )
+    elif requested:
+        peers = [ip for ip in _ip_list(zk.sort_peers(zkpeer))
+                 if ip in requested]
+        hookenv.log('Restart requested. Restart queue: {}'.format(peers))
+    else:
+        return
+
+    nonce = time.time()
+    leader_set(
+        restart_queue=json.dumps(peers),
+        restart_nonce=json.dumps(nonce)
+    )
+
+
+def _restart_requests(zkpeer):
+    '''
+    Return the ips of nodes that have asked for a restart (e.g., to move
+    their transaction logs) since we last looked.
+
+    '''
+    requests = {
+        hookenv.unit_get('private-address'):
+            unitdata.kv().get('zookeeper.restart_request'),
+    }
+    for conv in zkpeer.conversations():
+        requests[conv.get_remote('private-address')] = conv.get_remote(
+            'restart_request')
+
+    seen = unitdata.kv().get('zkpeer.restart_requests', {})
+    unitdata.kv().set('zkpeer.restart_requests', requests)
+    return [ip for ip, request in requests.items()
+            if request and seen.get(ip) != request]
 
 
 @when('zookeeper.started', 'leadership.is_leader', 'zkpeer.joined',
@@ -326,8 +463,7 @@ def check_cluster_changed(zkpeer):
 def restart_for_quorum(zkpeer):
     '''
     If we're the next node in the restart queue, restart, and then
-    inform the leader that we've restarted. (If we are the leader,
-    remove ourselves from the queue, and update the leadership data.)
+    wait for the server to rejoin the quorum (see `check_rejoin`).
 
     '''
     private_address = hookenv.unit_get('private-address')
@@ -337,15 +473,70 @@ def restart_for_quorum(zkpeer):
         # Everything has restarted.
         return
 
+    pending = unitdata.kv().get('zookeeper.rejoin')
+    if pending and pending['nonce'] == leader_get('restart_nonce'):
+        # We have already restarted for this queue.
+        return
+
     if private_address == queue[0]:
-        # It's our turn to restart.
+        # It's our turn to restart. Remember how far along we were, so
+        # that we can tell when we have caught up again.
+        zk = Zookeeper()
+        started = time.time()
+        zxid = zk.server_status().get('zxid', 0)
         _restart_zookeeper('rolling restart for quorum update')
-        if is_state('leadership.is_leader'):
-            queue = queue[1:]
-            hookenv.log('Leader updating restart queue: {}'.format(queue))
-            leader_set(restart_queue=json.dumps(queue))
-        else:
-            zkpeer.inform_restart()
+        unitdata.kv().set('zookeeper.rejoin', {
+            'nonce': leader_get('restart_nonce'),
+            'zxid': zxid,
+            'started': started,
+            'restarted': time.time(),
+        })
+        set_state('zookeeper.rejoin.pending')
+
+
+@when('zookeeper.rejoin.pending', 'zkpeer.joined')
+def check_rejoin(zkpeer):
+    '''
+    Wait for our freshly restarted server to rejoin the quorum, then
+    release the next node in the restart queue. (If we are the leader,
+    remove ourselves from the queue, and update the leadership data;
+    otherwise, inform the leader that we've restarted.)
+
+    '''
+    pending = unitdata.kv().get('zookeeper.rejoin')
+    if not pending or pending['nonce'] != leader_get('restart_nonce'):
+        # A newer restart queue has superseded the one we were part of.
+        remove_state('zookeeper.rejoin.pending')
+        return
+
+    zk = Zookeeper()
+    hookenv.status_set('maintenance', 'waiting to rejoin quorum')
+    if not zk.wait_for_rejoin(pending['zxid']):
+        hookenv.log('Zookeeper has not rejoined the quorum yet; '
+                    'will check again on the next hook.', level='WARN')
+        hookenv.status_set('waiting', 'waiting to rejoin quorum')
+        return
+
+    timing = {
+        'restart': round(pending['restarted'] - pending['started'], 3),
+        'rejoin': round(time.time() - pending['restarted'], 3),
+    }
+    hookenv.log('Rejoined quorum: {}'.format(timing))
+    unitdata.kv().unset('zookeeper.rejoin')
+    remove_state('zookeeper.rejoin.pending')
+    hookenv.status_set('active', 'ready {}'.format(zk.quorum_check()))
+
+    private_address = hookenv.unit_get('private-address')
+    if is_state('leadership.is_leader'):
+        queue = json.loads(leader_get('restart_queue') or '[]')
+        new_queue = [node for node in queue if node != private_address]
+        _record_restarts(queue, new_queue, {private_address: timing})
+    else:
+        nonce = leader_get('restart_nonce')
+        for conv in zkpeer.conversations():
+            conv.set_remote('restart_timing.{}'.format(nonce),
+                            json.dumps(timing))
+        zkpeer.inform_restart()
 
 
 @when('leadership.is_leader', 'zkpeer.joined')
@@ -363,5 +554,39 @@ def update_restart_queue(zkpeer):
     new_queue = [node for node in queue if node not in restarted_nodes]
 
     if new_queue != queue:
-        hookenv.log('Leader updating restart queue: {}'.format(queue))
-        leader_set(restart_queue=json.dumps(new_queue))
+        nonce = leader_get('restart_nonce')
+        timings = {}
+        for conv in zkpeer.conversations():
+            timing = conv.get_remote('restart_timing.{}'.format(nonce))
+            if timing:
+                timings[conv.get_remote('private-address')] = json.loads(
+                    timing)
+        _record_restarts(queue, new_queue, timings)
+
+
+def _record_restarts(queue, new_queue, timings):
+    '''
+    Update the restart queue, and keep track of how long each node took
+    to restart and rejoin. When the queue empties, report how long the
+    quorum was impacted by the rolling restart.
+
+    '''
+    nonce = leader_get('restart_nonce')
+    report = json.loads(leader_get('restart_report') or '{}')
+    if report.get('nonce') != nonce:
+        report = {'nonce': nonce, 'nodes': {}}
+    report['nodes'].update(
+        {ip: timing for ip, timing in timings.items() if ip in queue})
+
+    if not new_queue:
+        # Nodes restart one at a time, so the quorum is impacted for
+        # the sum of each node's restart and rejoin time.
+        report['quorum_impact'] = round(sum(
+            t['restart'] + t['rejoin'] for t in report['nodes'].values()), 3)
+        report['total'] = round(time.time() - float(json.loads(nonce)), 3)
+        hookenv.log('Rolling restart complete: quorum impacted for {}s '
+                    'of {}s'.format(report['quorum_impact'], report['total']))
+
+    hookenv.log('Leader updating restart queue: {}'.format(new_queue))
+    leader_set(restart_queue=json.dumps(new_queue),
+               restart_report=json.dumps(report))